@@ -0,0 +1,127 @@
+import sys
+import json
+import time
+import asyncio
+import inspect
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import coloredlogs
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict
+from tabulate import tabulate
+import halpert.util.openai
+from .suite import benchmarks
+
+logger = logging.getLogger('benchmarks')
+
+
+async def measure(op: Callable[[], Any], repeat: int, min_time: float) -> Dict:
+  async def run(loops: int) -> float:
+    started = time.perf_counter()
+    for _ in range(loops):
+      result = op()
+      if inspect.isawaitable(result):
+        await result
+    return time.perf_counter() - started
+
+  # like timeit, time enough loops that a single measurement takes at least min_time
+  loops = 1
+  while (elapsed := await run(loops)) < min_time:
+    loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9)))
+  times = [await run(loops) / loops for _ in range(repeat)]
+  return {
+    'loops': loops,
+    'repeat': repeat,
+    'min': min(times),
+    'median': statistics.median(times),
+    'mean': statistics.mean(times),
+    'stdev': statistics.stdev(times) if len(times) > 1 else 0,
+  }
+
+
+def commit() -> str | None:
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> int:
+  rows = []
+  regressions = 0
+  for name, result in results['benchmarks'].items():
+    before = baseline['benchmarks'].get(name)
+    if 'median' not in result or not before or 'median' not in before:
+      continue
+    change = result['median'] / before['median'] - 1
+    regressed = change > threshold
+    regressions += regressed
+    rows.append({
+      'Benchmark': name,
+      'Baseline (us)': before['median'] * 1e6,
+      'Current (us)': result['median'] * 1e6,
+      'Change': f'{change:+.1%}',
+      'Regression': 'yes' if regressed else '',
+    })
+  if rows:
+    table = tabulate({ k: [r[k] for r in rows] for k in rows[0].keys() }, headers='keys', floatfmt='.1f')
+    logger.info(f'Compared to {baseline.get("commit")}:\n' + table)
+  return regressions
+
+
+async def run():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--output', type=str, help='Path to write the results to as JSON')
+  parser.add_argument('--filter', type=str, help='Only run benchmarks whose name contains this')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--min-time', type=float, default=0.2, help='Minimum seconds per measurement')
+  parser.add_argument('--compare', type=str, help='Results of an earlier run to compare to')
+  parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown of the median that counts as a regression')
+  args = parser.parse_args()
+
+  coloredlogs.install(fmt='%(levelname)s %(asctime)s %(name)s %(message)s', level=logging.INFO)
+  # the code under benchmark logs at every step, which shouldn't be part of the results
+  logging.getLogger('halpert').setLevel(logging.WARNING)
+  logging.getLogger('example').setLevel(logging.WARNING)
+
+  results: Dict[str, Any] = {
+    'commit': commit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'created': datetime.now(timezone.utc).isoformat(),
+    'benchmarks': {},
+  }
+  defaults = halpert.util.openai.config.copy()
+  for name, setup in benchmarks.items():
+    if args.filter and args.filter not in name:
+      continue
+    with tempfile.TemporaryDirectory() as dir:
+      try:
+        op = setup(dir)
+      except ImportError as e:
+        logger.warning(f'Skipping {name}: {e}')
+        results['benchmarks'][name] = { 'skipped': str(e) }
+        continue
+      result = results['benchmarks'][name] = await measure(op, args.repeat, args.min_time)
+      logger.info(f'{name}: {result["median"] * 1e6:.1f}us median of {result["repeat"]}x{result["loops"]} loops')
+    # benchmarks configure completions as they need, so each starts from the defaults
+    halpert.util.openai.config = defaults.copy()
+    await halpert.util.openai.close()
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+
+  if args.compare:
+    with open(args.compare, 'r') as f:
+      baseline = json.load(f)
+    if compare(results, baseline, args.threshold):
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  asyncio.run(run())
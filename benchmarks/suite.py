@@ -0,0 +1,226 @@
+import os
+import json
+import random
+import itertools
+from typing import Any, Callable, Dict, List
+from halpert import Halpert, Sample, FunctionCall
+from halpert.functions.odoo.api import OdooAPI
+import halpert.util.openai
+from halpert.util.openai import ConversationHasher, create_hash, load_cached, save_cached
+from halpert.util.cache import SQLiteCache
+from halpert.util.bundle import Bundle, BundleWriter
+from halpert.util.scripted import ScriptedBackend
+
+# each benchmark is set up with a temporary directory, and returns the
+# operation to time, which can be a coroutine function
+Setup = Callable[[str], Callable[[], Any]]
+benchmarks: Dict[str, Setup] = {}
+
+
+def benchmark(name: str):
+  def register(setup: Setup) -> Setup:
+    benchmarks[name] = setup
+    return setup
+  return register
+
+
+class FakeOdooAPI(OdooAPI):
+  # answers requests locally instead of connecting to odoo
+  def __init__(self):
+    self.user_id = 1
+
+  def _request(self, model: str, op: str, args: List, options: Dict = {}):
+    if op == 'get_attendee_detail':
+      partner_ids = args[0]
+      return [{
+        'id': id,
+        'name': f'Partner {id}',
+        'status': 'accepted',
+        'is_organizer': id == partner_ids[0],
+      } for id in partner_ids]
+    raise NotImplementedError(f'{model}.{op}')
+
+
+def conversation(steps: int) -> List[Dict]:
+  messages = [
+    { 'role': 'system', 'content': 'You are a helpful AI assistant.' },
+    { 'role': 'user', 'content': 'Research the year 1092.' },
+  ]
+  for i in range(steps):
+    messages.append({ 'role': 'assistant', 'tool_calls': [{
+      'id': f'call_{i}',
+      'type': 'function',
+      'function': { 'name': 'search_wikipedia', 'arguments': json.dumps({ 'query': f'1092 event {i}' }) },
+    }] })
+    messages.append({ 'role': 'tool', 'tool_call_id': f'call_{i}', 'content': json.dumps({ 'results': ['lorem ipsum ' * 50] * 5 }) })
+  return messages
+
+
+def samples(count: int) -> List[Sample]:
+  import example.samples
+  return [
+    example.samples.samples[0].copy(update={ 'id': None, 'name': f'Sample {i}' })
+    for i in range(count)
+  ]
+
+
+def tools() -> List[Dict]:
+  from halpert.tools import tool
+  import halpert.functions.wikipedia
+  return [tool(halpert.functions.wikipedia.search), tool(halpert.functions.wikipedia.read_page)]
+
+
+@benchmark('openai.create_hash')
+def bench_create_hash(dir: str):
+  messages = conversation(20)
+  tools_ = tools()
+  return lambda: create_hash(messages, 'gpt-4-1106-preview', tools_, None)
+
+
+@benchmark('openai.conversation_hasher')
+def bench_conversation_hasher(dir: str):
+  # hashes a conversation that grew by one message since the last step
+  messages = conversation(20)
+  tools_ = tools()
+  hasher = ConversationHasher()
+  hasher.hash(messages, 'gpt-4-1106-preview', tools_, None)
+  def hash():
+    last = messages.pop()
+    messages.append(dict(last))
+    return hasher.hash(messages, 'gpt-4-1106-preview', tools_, None)
+  return hash
+
+
+@benchmark('openai.load_cached.memory')
+def bench_load_cached_memory(dir: str):
+  halpert.util.openai.config.cache = 'none'
+  halpert.util.openai.config.bundles = []
+  hash = create_hash(conversation(1))
+  save_cached(hash, { 'choices': [{ 'message': { 'role': 'assistant', 'content': 'lorem ipsum' } }] })
+  return lambda: load_cached(hash)
+
+
+@benchmark('cache.sqlite.get')
+def bench_sqlite_get(dir: str):
+  cache = SQLiteCache(os.path.join(dir, 'cache.sqlite'))
+  keys = [create_hash('key', i) for i in range(1000)]
+  for key in keys:
+    cache.set(key, { 'messages': conversation(2) })
+  rng = random.Random(0)
+  return lambda: cache.get(rng.choice(keys))
+
+
+@benchmark('cache.bundle.get')
+def bench_bundle_get(dir: str):
+  path = os.path.join(dir, 'cache.bundle')
+  keys = [create_hash('key', i) for i in range(1000)]
+  with BundleWriter(path) as writer:
+    for key in keys:
+      writer.add(key, { 'messages': conversation(2) })
+  bundle = Bundle(path)
+  rng = random.Random(0)
+  return lambda: bundle.get(rng.choice(keys))
+
+
+@benchmark('example.run_agent')
+def bench_run_agent(dir: str):
+  # the harness overhead of a run of 5 steps and the quiz, without caching
+  from example.__main__ import run_agent
+  halpert.util.openai.config.backend = ScriptedBackend(steps=5)
+  halpert.util.openai.config.cache = 'none'
+  halpert.util.openai.config.bundles = []
+  halpert.util.openai.config.memory_cache_size = 0
+  eval = Halpert(samples=samples(1))
+  sample = eval.samples[0]
+  async def run():
+    return await run_agent(sample, eval.prepare(sample, 'scripted'), 'scripted')
+  return run
+
+
+@benchmark('halpert.prepare')
+def bench_prepare(dir: str):
+  eval = Halpert(samples=samples(100))
+  cycle = itertools.cycle(eval.samples)
+  return lambda: eval.prepare(next(cycle))
+
+
+@benchmark('halpert.evaluate')
+def bench_evaluate(dir: str):
+  # 200 samples with 20 calls each, for 3 models
+  eval = Halpert(samples=samples(200))
+  rng = random.Random(0)
+  for model in ['a', 'b', 'c']:
+    for sample in eval.samples:
+      eval.results_[(sample.id, model)] = Halpert.Result(
+        sample=sample.id,
+        model=model,
+        calls=[FunctionCall(
+          function=rng.choice(['add', 'search_wikipedia', 'read_wikipedia_page']),
+          start=0,
+          latency=rng.random(),
+          input_size=rng.randint(10, 100),
+          output_size=rng.randint(100, 10000),
+        ) for _ in range(20)],
+        quiz=[Sample.Evaluation.QuizItem(question=q.question, answer=rng.choice([q.answer, ''])) for q in sample.expected.quiz],
+      )
+  return eval.evaluate
+
+
+@benchmark('wikipedia.content')
+def bench_content(dir: str):
+  from halpert.functions.wikipedia.util.dataset import content
+  section = (
+    '<h2>History<span class="mw-editsection">[edit]</span></h2>'
+    '<div role="note">Main article: History</div>'
+    '<p>The <a href="/wiki/Year">year</a> <b>1092</b> was a <i>leap year</i> starting on Wednesday. '
+    + 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 10 + '</p>'
+    '<ul>' + '<li><a href="/wiki/Event">Event</a> happened</li>' * 10 + '</ul>'
+    '<table><tr><th>Year</th><th>Event</th></tr>' + '<tr><td>1092</td><td>Event</td></tr>' * 10 + '</table>'
+    '<script>var x = 1;</script><style>p { color: red; }</style>'
+  )
+  html = '<div class="mw-parser-output">' + section * 50 + '</div>'
+  return lambda: content(html)
+
+
+@benchmark('wikipedia.embedded.search')
+def bench_embedded_search(dir: str):
+  from halpert.functions.wikipedia.util.embedded import EmbeddedBackend, build
+  rng = random.Random(0)
+  words = [f'word{i}' for i in range(5000)] + ['the', 'of', 'and'] * 500
+  pages = []
+  for i in range(2000):
+    text = ' '.join(rng.choice(words) for _ in range(rng.randint(50, 1000)))
+    title = f'{rng.choice(words)} {rng.choice(words)}'
+    pages.append({ 'slug': f'{title.replace(" ", "_")}_{i}', 'title': title, 'markdown': text, 'text': text, 'summary': text[:1000] })
+  build(pages, dir)
+  backend = EmbeddedBackend(dir)
+  queries = itertools.cycle(['the history of word12', 'word1 word2 word3', 'and of the', 'word4999'])
+  return lambda: backend.search(next(queries), 10, 300)
+
+
+@benchmark('odoo.event_from_api')
+def bench_event_from_api(dir: str):
+  from halpert.functions.odoo.modules.calendar.types import Event
+  odoo = FakeOdooAPI()
+  data = {
+    'id': 1,
+    'display_name': 'Meeting',
+    'description': '<p>Discuss the roadmap</p>',
+    'allday': False,
+    'start': '2023-11-26 10:00:00',
+    'stop': '2023-11-26 11:00:00',
+    'partner_ids': list(range(1, 11)),
+  }
+  return lambda: Event.from_api(data, odoo)
+
+
+@benchmark('odoo.fields_to_specification')
+def bench_fields_to_specification(dir: str):
+  odoo = FakeOdooAPI()
+  fields = [
+    f'{relation}.{nested}.{field}'
+    for relation in ['partner_id', 'user_id', 'order_line', 'company_id', 'currency_id']
+    for nested in ['product_id', 'country_id']
+    for field in ['id', 'name', 'display_name', 'email', 'phone']
+  ] + ['id', 'name', 'date_order', 'amount_total', 'state']
+  return lambda: odoo._fields_to_specification(fields)
@@ -1,13 +1,19 @@
 import json
+import time
 import asyncio
 import argparse
+import contextlib
 import logging
 import coloredlogs
 # from openai.types.chat import ChatCompletionMessageParam
 from tqdm import tqdm
-from typing import List, Dict
-from halpert import Halpert, Sample, Function
-from halpert.util.openai import complete
+from pydantic import BaseModel
+from typing import Any, List, Dict, Tuple, Awaitable, Callable
+from halpert import Halpert, Sample, OdooSample, Function, FunctionCall, ToolRegistry, Budget, Usage
+from halpert.main import recorded_calls
+import halpert.util.openai
+import halpert.functions.wikipedia
+from halpert.util.openai import complete, ConversationHasher
 from .samples import samples
 
 ChatCompletionMessageParam = Dict
@@ -15,11 +21,51 @@ ChatCompletionMessageParam = Dict
 logger = logging.getLogger('halpert')
 
 
+class FunctionScheduler:
+  # starts each function call as soon as it is made. calls to functions that
+  # don't mutate state run concurrently, while calls to functions that do run
+  # on their own, in the order the model made them
+  def __init__(self):
+    self.tasks: List[asyncio.Task] = []
+    self.barrier: asyncio.Task | None = None
+    self.closed = False
+
+
+  def submit(self, mutates: bool, call: Callable[[], Awaitable[BaseModel]]):
+    if self.closed:
+      return
+    previous = list(self.tasks) if mutates else [self.barrier] if self.barrier else []
+    async def run():
+      await asyncio.gather(*previous)
+      return await call()
+    task = asyncio.ensure_future(run())
+    # calls whose step is abandoned are never awaited, so their errors are retrieved here
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    self.tasks.append(task)
+    if mutates:
+      self.barrier = task
+
+
+  async def results(self) -> List[BaseModel]:
+    return await asyncio.gather(*self.tasks)
+
+
+  def close(self):
+    # calls that are still running when their step ends, e.g. because it was
+    # cancelled or failed, are cancelled as well
+    self.closed = True
+    for task in self.tasks:
+      task.cancel()
+
+
 async def run_agent(
   sample: Sample,
   functions: List[Function],
   model: str,
-) -> List[Sample.Evaluation.QuizItem]:
+  budget: Budget = Budget(),
+  context_tokens: int | None = None,
+  stream: bool = False,
+) -> Tuple[List[Sample.Evaluation.QuizItem], Usage]:
   messages: List[ChatCompletionMessageParam] = [{
     'role': 'system',
     'content': 'You are a helpful AI assistant. Follow the instructions and use the available functions to complete the task. Always call functions, and never respond with a text message! Do not make any assumptions about the task, and do not use any outside knowledge.',
@@ -28,62 +74,132 @@ async def run_agent(
     'content': sample.instructions,
   }]
 
-  looping = True
-  while looping:
-    completion = complete(
-      messages=messages,
-      model=model,
-      tools=[{
-        'type': 'function',
-        'function': {
-          'name': f.slug,
-          'description': f.description,
-          'parameters': f.Input.schema(),
-        },
-      } for f in functions] + [{
-        'type': 'function',
-        'function': {
-          'name': 'done',
-          'description': 'Call this function when you are done with the task.',
-          'parameters': { 'type': 'object', 'properties': {} },
-        },
-      }],
-    )
-
-    # logger.info(f'Agent Step: {completion.json(indent=2)}')
-    logger.info(f'Agent Step: {json.dumps(completion, indent=2)}')
-
-    choice = completion.choices[0]
-    if choice.finish_reason != 'tool_calls':
-      logger.warning(f'Unexpected finish reason: {choice.finish_reason}')
-      break
-
-    messages.append({
-      'role': 'assistant',
-      # 'tool_calls': choice.message.dict()['tool_calls'],
-      'tool_calls': choice.message['tool_calls'],
-    })
-
-    for tc in choice.message.tool_calls:
-      if tc.function.name == 'done':
-        messages.pop()
-        looping = False
-        break
-      elif fn := next((f for f in functions if f.slug == tc.function.name), None):
-        output = await fn.call(fn.Input(**json.loads(tc.function.arguments)))
-        messages.append({
+  registry = ToolRegistry(functions, [{
+    'type': 'function',
+    'function': {
+      'name': 'done',
+      'description': 'Call this function when you are done with the task.',
+      'parameters': { 'type': 'object', 'properties': {} },
+    },
+  }])
+  hasher = ConversationHasher()
+  usage = Usage()
+  started = time.perf_counter()
+
+  def add_usage(completion):
+    if 'usage' in completion:
+      usage.prompt_tokens += completion.usage.prompt_tokens
+      usage.completion_tokens += completion.usage.completion_tokens
+
+  async def loop():
+    while True:
+      if budget.steps is not None and usage.steps >= budget.steps:
+        usage.exhausted = 'steps'
+        return
+
+      looping = True
+      done = False
+      completed = False
+      calls: List[Tuple[Any, Function]] = []
+      pending: List[Tuple[bool, Callable[[], Awaitable[BaseModel]]]] = []
+      scheduler = FunctionScheduler()
+      records: List[FunctionCall] = []
+      recorded_calls.set(records)
+
+      def on_tool_call(tc):
+        nonlocal looping, done
+        if not looping:
+          return
+        if tc.function.name == 'done':
+          done = True
+          looping = False
+        elif fn := registry.get(tc.function.name):
+          calls.append((tc, fn))
+          call = lambda: fn.call(registry.parse(fn.slug, tc.function.arguments))
+          # calls that mutate state, and the calls after them so that they keep
+          # their order, only start once the step is known to be kept
+          if fn.mutates or pending:
+            pending.append((fn.mutates, call))
+          else:
+            scheduler.submit(fn.mutates, call)
+        else:
+          logger.warning(f'Unexpected function call: {tc.function.name}')
+          looping = False
+
+      if context_tokens is not None:
+        messages[:] = registry.compact(messages, context_tokens)
+      try:
+        # when streaming, functions are called while the rest of the completion is generated
+        completion = await complete(
+          messages=messages,
+          model=model,
+          tools=registry.tools,
+          hasher=hasher,
+          on_tool_call=on_tool_call if stream else None,
+        )
+        usage.steps += 1
+        add_usage(completion)
+
+        # logger.info(f'Agent Step: {completion.json(indent=2)}')
+        logger.info(f'Agent Step: {json.dumps(completion, indent=2)}')
+
+        choice = completion.choices[0]
+        if choice.finish_reason != 'tool_calls':
+          logger.warning(f'Unexpected finish reason: {choice.finish_reason}')
+          return
+
+        if not stream:
+          for tc in choice.message.tool_calls:
+            on_tool_call(tc)
+        for mutates, call in pending:
+          scheduler.submit(mutates, call)
+        outputs = await scheduler.results()
+        completed = True
+      finally:
+        scheduler.close()
+        if not completed:
+          for record in records:
+            record.discarded = True
+
+      # the messages of a step are only added once all its calls returned, so
+      # that the conversation stays complete if the loop is cancelled midway
+      step: List[ChatCompletionMessageParam] = [{
+        'role': 'assistant',
+        # 'tool_calls': choice.message.dict()['tool_calls'],
+        'tool_calls': choice.message['tool_calls'],
+      }]
+      for (tc, fn), output in zip(calls, outputs):
+        step.append({
           'role': 'tool',
           'tool_call_id': tc.id,
           'content': json.dumps(output.dict()),
         })
 
         logger.info(f'Function call: {fn.slug}({tc.function.arguments}) -> {json.dumps(output.dict(), indent=2)}')
-      else:
-        logger.warning(f'Unexpected function call: {tc.function.name}')
-        looping = False
-        break
-  
-  completion = complete(
+
+      if done:
+        step.pop()
+      messages.extend(step)
+      if not looping:
+        return
+
+      if budget.prompt_tokens is not None and usage.prompt_tokens >= budget.prompt_tokens:
+        usage.exhausted = 'prompt_tokens'
+        return
+      if budget.completion_tokens is not None and usage.completion_tokens >= budget.completion_tokens:
+        usage.exhausted = 'completion_tokens'
+        return
+
+  try:
+    await asyncio.wait_for(loop(), budget.seconds)
+  except asyncio.TimeoutError:
+    usage.exhausted = 'seconds'
+  if usage.exhausted:
+    logger.warning(f'Budget exhausted after {usage.steps} steps: {usage.exhausted}')
+
+  if context_tokens is not None:
+    messages[:] = registry.compact(messages, context_tokens)
+  completion = await complete(
     messages=[{
       'role': 'system',
       'content': 'You are a helpful AI assistant. Answer the questions based on the messages so far using the answer function. Question:\n' + '\n'.join([f'{i}. {q.question}' for i, q in enumerate(sample.expected.quiz)]),
@@ -108,37 +224,142 @@ async def run_agent(
     }],
     model=model,
     tool_choice={ 'type': 'function', 'function': { 'name': 'answer' } },
+    hasher=hasher,
   )
 
   # logger.info(f'Agent Questions: {completion.json(indent=2)}')
   logger.info(f'Agent Questions: {json.dumps(completion, indent=2)}')
+  add_usage(completion)
+  usage.seconds = time.perf_counter() - started
   answers = json.loads(completion.choices[0].message.tool_calls[0].function.arguments)['answers']
 
   return [
     Sample.Evaluation.QuizItem(question=q.question, answer=a)
     for q, a in zip(sample.expected.quiz, answers)
-  ]
+  ], usage
+
+
+def shard(value: str) -> Tuple[int, int]:
+  index, count = value.split('/')
+  return int(index), int(count)
 
 
 async def run():
   parser = argparse.ArgumentParser()
   parser.add_argument('--model', type=str, default='gpt-4-1106-preview')
+  parser.add_argument('--models', type=lambda value: value.split(','), help='Comma separated models to compare on the same samples')
   parser.add_argument('--odoo-snapshot-dir', type=str)
+  parser.add_argument('--concurrency', type=int, default=1)
+  parser.add_argument('--requests-per-minute', type=float)
+  parser.add_argument('--max-steps', type=int, help='Maximum number of agent steps per sample')
+  parser.add_argument('--max-prompt-tokens', type=int, help='Maximum number of prompt tokens per sample')
+  parser.add_argument('--max-completion-tokens', type=int, help='Maximum number of completion tokens per sample')
+  parser.add_argument('--max-seconds', type=float, help='Maximum number of seconds per sample')
+  parser.add_argument('--context-tokens', type=int, help='Truncate, and then remove, the function outputs of earlier steps once the conversation is longer than this')
+  parser.add_argument('--stream', action='store_true', help='Stream completions, and call functions that don\'t mutate state as soon as their arguments are complete')
+  parser.add_argument('--backend', type=str, choices=['openai', 'scripted'], default='openai', help='Use a local scripted stand-in for the chat completions api, to load test the harness')
+  parser.add_argument('--scripted-latency', type=float, default=0)
+  parser.add_argument('--wikipedia-backend', type=str, choices=['elasticsearch', 'embedded'], default='elasticsearch', help='Search Wikipedia in elasticsearch, or in a local index built with python3 -m halpert.functions.wikipedia.util.embedded')
+  parser.add_argument('--cache', type=str, choices=['sqlite', 'file', 'none'], default='sqlite')
+  parser.add_argument('--cache-functions', action='store_true', help='Serve function outputs from the cache as well, to replay runs offline')
+  parser.add_argument('--bundle', type=str, action='append', default=[], help='Replay bundle to read completions and function outputs from')
+  parser.add_argument('--cache-keys', type=str, help='Path to write the keys of all cache entries used by this run to, for exporting a bundle')
+  parser.add_argument('--tokens-per-minute', type=float)
+  parser.add_argument('--shard', type=shard, help='Only run shard i/N of the samples, e.g. 0/4')
+  parser.add_argument('--results', type=str, help='Path to write the results of this run to')
+  parser.add_argument('--trace', type=str, help='Path to write a Chrome trace of all function calls to')
+  parser.add_argument('--journal', type=str, help='Path to append the result of each sample to as soon as it completes')
+  parser.add_argument('--resume', action='store_true', help='Skip samples that are already completed in the journal')
+  parser.add_argument('--merge', type=str, nargs='+', help='Evaluate the results files of earlier runs instead of running samples')
   args = parser.parse_args()
 
   coloredlogs.install(fmt='%(levelname)s %(asctime)s %(name)s %(message)s', level=logging.DEBUG)
   logging.getLogger('openai').setLevel(logging.INFO)
   logging.getLogger('httpx').setLevel(logging.INFO)
 
-  eval = Halpert(samples=samples, odoo_snapshot_dir=args.odoo_snapshot_dir)
-  for sample in tqdm(eval.samples):
-    sample_functions = eval.prepare(sample)
-    logger.info(f'Running sample: {sample.name}')
-    quiz = await run_agent(sample, sample_functions, args.model)
-    logger.info(f'Quiz: {json.dumps([q.dict() for q in quiz], indent=2)}')
-    eval.submit(sample, quiz)
+  if args.resume and not args.journal:
+    parser.error('--resume requires --journal')
+
+  halpert.functions.wikipedia.config.backend = args.wikipedia_backend
+  halpert.util.openai.config.cache = args.cache
+  halpert.util.openai.config.bundles = args.bundle
+  if args.backend == 'scripted':
+    from halpert.util.scripted import ScriptedBackend
+    halpert.util.openai.config.backend = ScriptedBackend(latency=args.scripted_latency)
+    # load tests exercise the harness, so completions aren't served from or written to the cache
+    halpert.util.openai.config.cache = 'none'
+    halpert.util.openai.config.bundles = []
+    halpert.util.openai.config.memory_cache_size = 0
+  halpert.util.openai.config.requests_per_minute = args.requests_per_minute
+  halpert.util.openai.config.tokens_per_minute = args.tokens_per_minute
+
+  eval = Halpert(
+    samples=samples,
+    odoo_snapshot_dir=args.odoo_snapshot_dir,
+    journal_path=args.journal,
+    cache_functions=args.cache_functions,
+  )
+  if args.merge:
+    for path in args.merge:
+      eval.load(path)
+    if args.trace:
+      eval.export_trace(args.trace)
+    eval.evaluate()
+    return
+
+  models = args.models or [args.model]
+  budget = Budget(
+    steps=args.max_steps,
+    prompt_tokens=args.max_prompt_tokens,
+    completion_tokens=args.max_completion_tokens,
+    seconds=args.max_seconds,
+  )
+  semaphore = asyncio.Semaphore(args.concurrency)
+  # all odoo samples share the same odoo instance, so only one of them can run at a time
+  odoo_lock = asyncio.Lock()
+
+  async def run_model(sample: Sample, sample_functions: List[Function], model: str):
+    async with semaphore:
+      logger.info(f'Running sample: {sample.name} ({model})')
+      quiz, usage = await run_agent(sample, sample_functions, model, sample.budget or budget, args.context_tokens, args.stream)
+      logger.info(f'Quiz: {json.dumps([q.dict() for q in quiz], indent=2)}')
+      eval.submit(sample, quiz, model, usage)
+      progress.update()
+
+  async def run_sample(sample: Sample, sample_models: List[str]):
+    async with odoo_lock if isinstance(sample, OdooSample) else contextlib.nullcontext():
+      if sample.read_only:
+        # the environment is only read from, so all models can share it
+        eval.prepare_environment(sample)
+        await asyncio.gather(*[run_model(sample, eval.instrument(sample, model), model) for model in sample_models])
+      else:
+        for model in sample_models:
+          await run_model(sample, eval.prepare(sample, model), model)
+
+  run_samples = eval.shard(*args.shard) if args.shard else eval.samples
+  if args.resume:
+    eval.resume()
+  runs = [(sample, [m for m in models if not args.resume or not eval.completed(sample, m)]) for sample in run_samples]
+  runs = [(sample, sample_models) for sample, sample_models in runs if sample_models]
+  progress = tqdm(total=sum(len(sample_models) for _, sample_models in runs))
+  try:
+    await asyncio.gather(*[run_sample(sample, sample_models) for sample, sample_models in runs])
+  finally:
+    progress.close()
+    await halpert.util.openai.close()
+    await halpert.functions.wikipedia.close()
+
+  logger.info(f'Completion cache: {halpert.util.openai.stats}')
+  if args.cache_keys:
+    with open(args.cache_keys, 'w') as f:
+      f.write(''.join(f'{key}\n' for key in sorted(halpert.util.openai.used_keys)))
 
-  eval.evaluate()
+  if args.results:
+    eval.save(args.results)
+  if args.trace:
+    eval.export_trace(args.trace)
+  if not args.shard:
+    eval.evaluate()
 
 
 if __name__ == '__main__':
@@ -1,5 +1,9 @@
 
 from .main import Halpert as Halpert
+from .types import Budget as Budget
 from .types import Function as Function
+from .types import FunctionCall as FunctionCall
 from .types import Sample as Sample
 from .types import OdooSample as OdooSample
+from .types import Usage as Usage
+from .tools import ToolRegistry as ToolRegistry
@@ -0,0 +1,77 @@
+import argparse
+import logging
+from tqdm import tqdm
+import halpert.util.openai
+from halpert.util.bundle import Bundle, BundleWriter
+
+
+logger = logging.getLogger(__name__)
+
+
+def export_bundle(output: str, keys_path: str | None):
+  cache = halpert.util.openai.get_cache()
+  if cache is None:
+    raise ValueError('No cache to export from')
+
+  if keys_path:
+    with open(keys_path, 'r') as f:
+      keys = [line.strip() for line in f if line.strip()]
+  else:
+    keys = cache.keys()
+
+  missing = 0
+  with BundleWriter(output) as writer:
+    for key in tqdm(keys, desc='Exporting'):
+      entry = cache.get(key)
+      if entry is None:
+        missing += 1
+        continue
+      writer.add(key, entry.value, entry.latency)
+
+  if missing:
+    logger.warning(f'{missing} keys were not found in the cache')
+  logger.info(f'Exported {len(keys) - missing} entries to {output}')
+
+
+def import_bundle(path: str):
+  cache = halpert.util.openai.get_cache()
+  if cache is None:
+    raise ValueError('No cache to import into')
+
+  bundle = Bundle(path)
+  for key, entry in tqdm(bundle, total=len(bundle), desc='Importing'):
+    cache.set(key, entry.value, entry.latency)
+  bundle.close()
+  logger.info(f'Imported {len(bundle)} entries from {path}')
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='halpert')
+  parser.add_argument('--cache', type=str, choices=['sqlite', 'file'], default='sqlite')
+  parser.add_argument('--cache-path', type=str)
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  cache_parser = commands.add_parser('cache')
+  cache_commands = cache_parser.add_subparsers(dest='cache_command', required=True)
+
+  export_parser = cache_commands.add_parser('export', help='Pack cache entries into a replay bundle')
+  export_parser.add_argument('output', type=str)
+  export_parser.add_argument('--keys', type=str, help='File with the keys to export, as written by a run with --cache-keys. Defaults to all entries')
+
+  import_parser = cache_commands.add_parser('import', help='Load a replay bundle into the cache')
+  import_parser.add_argument('bundle', type=str)
+
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  halpert.util.openai.config.cache = args.cache
+  halpert.util.openai.config.cache_path = args.cache_path
+
+  if args.cache_command == 'export':
+    export_bundle(args.output, args.keys)
+  elif args.cache_command == 'import':
+    import_bundle(args.bundle)
+
+
+if __name__ == '__main__':
+  main()
@@ -39,6 +39,7 @@ create_event = Function(
   name='Create Calendar Event',
   description='Create and event in Odoo Calendar',
   icon='http://localhost:8069/calendar/static/description/icon.png',
+  mutates=True,
   Input=Input,
   Output=Output,
   call=create_event_call,
@@ -52,6 +52,7 @@ create_customer = Function(
   name='Create Customer',
   description='Create customer in Odoo eCommerce',
   icon='http://localhost:8069/website_sale/static/description/icon.png',
+  mutates=True,
   Input=Input,
   Output=Output,
   call=create_customer_call,
@@ -1,5 +1,5 @@
-import arrow
 from halpert import Function
+from halpert.util import clock
 from pydantic import BaseModel, Field
 from typing import List
 from ...api import OdooAPI
@@ -25,7 +25,7 @@ class Output(BaseModel):
 async def create_order_call(input: Input) -> Output:
   odoo = OdooAPI()
   # see command[1] here: https://github.com/odoo/odoo/blob/20ddb74a8aefbde137f5c47a769f26ec8a4f7113/odoo/fields.py#L4186
-  ref = f'virtual_{round(arrow.utcnow().timestamp())}'
+  ref = f'virtual_{round(clock.utcnow().timestamp())}'
   record = odoo.create(
     'sale.order',
     {
@@ -50,6 +50,7 @@ create_order = Function(
   name='Create Order',
   description='Create order in Odoo eCommerce',
   icon='http://localhost:8069/website_sale/static/description/icon.png',
+  mutates=True,
   Input=Input,
   Output=Output,
   call=create_order_call,
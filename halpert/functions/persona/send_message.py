@@ -28,7 +28,7 @@ logger = logging.getLogger(__name__)
 
 async def send_message_call(input: Input, context: Context) -> Output:
   context.history.append(('input', input.message))
-  completion = complete(
+  completion = await complete(
     messages=[
       {
         'role': 'system',
@@ -66,13 +66,19 @@ async def send_message_call(input: Input, context: Context) -> Output:
 
 
 def send_message_with_context(persona: str, history: List[Tuple[Literal['input', 'output'], str]] = []) -> Function:
-  context = Context(persona=persona, history=history)
+  def create_call():
+    # every run talks to the persona from the start of the conversation
+    context = Context(persona=persona, history=list(history))
+    return lambda input: send_message_call(input, context)
+
   return Function(
     name='Send Message',
     description='Send a message',
+    mutates=True,
     Input=Input,
     Output=Output,
-    call=lambda input: send_message_call(input, context),
+    call=create_call(),
+    create_call=create_call,
   )
 
 
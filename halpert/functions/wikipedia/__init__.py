@@ -1,3 +1,7 @@
 
 from .search import search as search
 from .read_page import read_page as read_page
+from .read_page_outline import read_page_outline as read_page_outline
+from .read_page_section import read_page_section as read_page_section
+from .util.config import config as config
+from .util.backend import close as close
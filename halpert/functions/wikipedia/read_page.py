@@ -1,6 +1,9 @@
-from elasticsearch import AsyncElasticsearch
+from collections import OrderedDict
+from urllib.parse import urlparse, quote, unquote
 from halpert.types import Function
 from pydantic import BaseModel, Field
+from .util.backend import get_backend
+from .util.config import config
 
 class Input(BaseModel):
   link: str
@@ -12,25 +15,41 @@ class Output(BaseModel):
   
   page: Page | None
 
-async def read_page_call(
-  input: Input,
-  index_name: str = 'wikipedia',
-  host: str = 'http://localhost:9200',
-) -> Output:
-  async with AsyncElasticsearch([host]) as es:
-    slug = input.link.replace('/wiki/', '')
-    # match document by slug
-    response = await es.search(index=index_name, query={
-      'match': { 'slug': slug },
-    }, size=1)
-
-    if len(response['hits']['hits']) == 0:
-      return Output(page=None)
-    hit = response['hits']['hits'][0]['_source']
-    return Output(page=Output.Page(
-      title=hit['title'],
-      content=hit['markdown'],
-    ))
+# recently read pages, by backend and slug, so that pages read again don't go to the backend
+_pages: OrderedDict[tuple, Output.Page | None] = OrderedDict()
+
+
+def slug_to_link(slug: str) -> str:
+  # titles can contain ? and %, so they are percent encoded to read back the same
+  return '/wiki/' + quote(slug, safe="/:@!$&'()*+,;=")
+
+
+def link_to_slug(link: str) -> str:
+  # links can be absolute or relative, percent encoded, contain spaces or
+  # point to a section of the page. titles never contain #, but can contain
+  # ?, so only absolute urls are taken to have a query
+  path = link.split('#', 1)[0]
+  if urlparse(path).netloc:
+    path = urlparse(path).path
+  slug = unquote(path[path.find('/wiki/') + len('/wiki/'):] if '/wiki/' in path else path).replace(' ', '_')
+  # the first letter of a title is always upper case
+  return slug[:1].upper() + slug[1:]
+
+
+async def read_page_call(input: Input) -> Output:
+  key = (get_backend(), link_to_slug(input.link))
+  if key in _pages:
+    _pages.move_to_end(key)
+    return Output(page=_pages[key])
+
+  hit = await key[0].get_page(key[1])
+  page = Output.Page(title=hit['title'], content=hit['markdown']) if hit else None
+
+  if config.page_cache_size > 0:
+    _pages[key] = page
+    while len(_pages) > config.page_cache_size:
+      _pages.popitem(last=False)
+  return Output(page=page)
 
 
 read_page = Function(
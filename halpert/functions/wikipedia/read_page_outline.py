@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from typing import List
+from halpert.types import Function
+from pydantic import BaseModel
+from .read_page import link_to_slug
+from .util.backend import get_backend
+from .util.config import config
+
+class Input(BaseModel):
+  link: str
+
+class Output(BaseModel):
+  class Page(BaseModel):
+    class Section(BaseModel):
+      index: int
+      title: str
+      level: int
+      start: int
+      length: int
+
+    title: str
+    length: int
+    sections: List[Section]
+
+  page: Page | None
+
+# recently read outlines, by backend and slug
+_outlines: OrderedDict[tuple, Output.Page | None] = OrderedDict()
+
+
+async def get_outline(slug: str) -> Output.Page | None:
+  key = (get_backend(), slug)
+  if key in _outlines:
+    _outlines.move_to_end(key)
+    return _outlines[key]
+
+  hit = await key[0].get_outline(slug)
+  page = Output.Page(
+    title=hit['title'],
+    length=hit['length'],
+    sections=[Output.Page.Section(
+      index=i,
+      title=section['title'],
+      level=section['level'],
+      start=section['start'],
+      length=section['end'] - section['start'],
+    ) for i, section in enumerate(hit['sections'])],
+  ) if hit else None
+
+  if config.page_cache_size > 0:
+    _outlines[key] = page
+    while len(_outlines) > config.page_cache_size:
+      _outlines.popitem(last=False)
+  return page
+
+
+async def read_page_outline_call(input: Input) -> Output:
+  return Output(page=await get_outline(link_to_slug(input.link)))
+
+
+read_page_outline = Function(
+  name='Read Wikipedia Page Outline',
+  description='Read the table of contents of a Wikipedia page by a link. Use Read Wikipedia Page Section to read its sections',
+  Input=Input,
+  Output=Output,
+  call=lambda input: read_page_outline_call(input),
+)
@@ -0,0 +1,61 @@
+from halpert.types import Function
+from pydantic import BaseModel, Field
+from .read_page import link_to_slug
+from .read_page_outline import get_outline
+from .util.backend import get_backend
+from .util.config import config
+
+class Input(BaseModel):
+  link: str
+  section: int | None = Field(None, description='Index of the section in the outline of the page')
+  start: int | None = Field(None, description='Character to start reading at, if no section is given')
+  length: int | None = Field(None, description='Number of characters to read, if no section is given')
+
+class Output(BaseModel):
+  class Page(BaseModel):
+    title: str
+    content: str = Field(description='Markdown content')
+    start: int
+    end: int
+    length: int = Field(description='Number of characters in the whole page')
+
+  page: Page | None
+  error: str | None = Field(None, description='Why nothing was read, if the input was invalid')
+
+async def read_page_section_call(input: Input) -> Output:
+  slug = link_to_slug(input.link)
+  outline = await get_outline(slug)
+  if outline is None:
+    return Output(page=None)
+
+  # the input comes from the model, so it is clamped or reported back rather than raised
+  if input.section is not None:
+    if not 0 <= input.section < len(outline.sections):
+      return Output(page=None, error=f'Section {input.section} does not exist, the page has {len(outline.sections)} sections')
+    section = outline.sections[input.section]
+    start, end = section.start, section.start + section.length
+  else:
+    length = config.section_length if input.length is None else input.length
+    start = min(max(input.start or 0, 0), outline.length)
+    end = min(start + min(max(length, 0), config.section_length), outline.length)
+
+  # only the part that is read is loaded from the backend
+  content = await get_backend().get_range(slug, start, end)
+  if content is None:
+    return Output(page=None)
+  return Output(page=Output.Page(
+    title=outline.title,
+    content=content,
+    start=start,
+    end=end,
+    length=outline.length,
+  ))
+
+
+read_page_section = Function(
+  name='Read Wikipedia Page Section',
+  description='Read a section of a Wikipedia page from its outline, or a range of characters of the page',
+  Input=Input,
+  Output=Output,
+  call=lambda input: read_page_section_call(input),
+)
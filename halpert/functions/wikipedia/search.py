@@ -1,8 +1,10 @@
 import asyncio
-from elasticsearch import AsyncElasticsearch
 from typing import List
 from halpert.types import Function
 from pydantic import BaseModel
+from .read_page import slug_to_link
+from .util.backend import get_backend, close
+from .util.config import config
 
 class Input(BaseModel):
   query: str
@@ -17,29 +19,15 @@ class Output(BaseModel):
 
 async def search_call(
   input: Input,
-  index_name: str = 'wikipedia',
-  host: str = 'http://localhost:9200',
-  snippet_size: int = 300,
+  size: int | None = None,
+  snippet_size: int | None = None,
 ) -> Output:
-  async with AsyncElasticsearch([host]) as es:
-    response = await es.search(index=index_name, query={
-      'multi_match': {
-        'query': input.query,
-        'fields': ['title^2', 'text'],
-        # 'fields': ['title', 'text'],
-      },
-    }, highlight={
-      'fields': {
-        'title': { 'pre_tags': [''], 'post_tags': [''] },
-        'text': { 'pre_tags': [''], 'post_tags': [''], 'fragment_size': snippet_size },
-      },
-    }, size=10)
-  
-    return Output(results=[Output.Result(
-      link='/wiki/' + hit['_source']['slug'],
-      title=hit['_source']['title'],
-      snippet=hit['highlight'].get('text', [hit['_source']['text'][:snippet_size]])[0]
-     ) for hit in response['hits']['hits']])
+  results = await get_backend().search(input.query, size or config.search_size, snippet_size or config.snippet_size)
+  return Output(results=[Output.Result(
+    link=slug_to_link(result['slug']),
+    title=result['title'],
+    snippet=result['snippet'],
+  ) for result in results])
 
 
 search = Function(
@@ -56,12 +44,22 @@ if __name__ == '__main__':
 
   parser = argparse.ArgumentParser()
   parser.add_argument('--query', type=str, required=True)
+  parser.add_argument('--backend', type=str, choices=['elasticsearch', 'embedded'], default='elasticsearch')
   parser.add_argument('--index-name', type=str, default='wikipedia')
   parser.add_argument('--host', type=str, default='http://localhost:9200')
   args = parser.parse_args()
 
-  loop = asyncio.get_event_loop()
-  results = loop.run_until_complete(search_call(Input(query=args.query), args.index_name, args.host))
+  config.backend = args.backend
+  config.host = args.host
+  config.index_name = args.index_name
+
+  async def main():
+    try:
+      return await search_call(Input(query=args.query))
+    finally:
+      await close()
+
+  results = asyncio.run(main())
   import json
   print(json.dumps(results.dict(), indent=2))
   print(len(results))
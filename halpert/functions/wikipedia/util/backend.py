@@ -0,0 +1,59 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List
+from .config import config
+
+
+class Backend(ABC):
+  @abstractmethod
+  async def search(self, query: str, size: int, snippet_size: int) -> List[Dict]:
+    # results with a slug, title and snippet, best first
+    ...
+
+  @abstractmethod
+  async def get_page(self, slug: str) -> Dict | None:
+    # the title and markdown of a page
+    ...
+
+  @abstractmethod
+  async def get_outline(self, slug: str) -> Dict | None:
+    # the title, length and sections of a page
+    ...
+
+  @abstractmethod
+  async def get_range(self, slug: str, start: int, end: int) -> str | None:
+    # characters start to end of the markdown of a page
+    ...
+
+  async def close(self):
+    pass
+
+
+_backend: Backend | None = None
+_backend_config: tuple | None = None
+# backends of an earlier config, which are closed with the current one
+_replaced: List[Backend] = []
+
+
+def get_backend() -> Backend:
+  global _backend, _backend_config
+  backend_config = (config.backend, config.host, config.index_name, config.embedded_dir)
+  if _backend is None or backend_config != _backend_config:
+    if _backend is not None:
+      _replaced.append(_backend)
+    if config.backend == 'embedded':
+      from .embedded import EmbeddedBackend
+      _backend = EmbeddedBackend(config.embedded_dir)
+    else:
+      from .elastic import ElasticsearchBackend
+      _backend = ElasticsearchBackend(config.host, config.index_name)
+    _backend_config = backend_config
+  return _backend
+
+
+async def close():
+  global _backend, _replaced
+  backends = _replaced + ([_backend] if _backend is not None else [])
+  _backend = None
+  _replaced = []
+  for backend in backends:
+    await backend.close()
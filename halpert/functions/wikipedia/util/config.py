@@ -0,0 +1,29 @@
+import os
+from pydantic import BaseModel
+from typing import Literal
+
+
+class Config(BaseModel):
+  # where search and read_page look pages up: an elasticsearch index, or an
+  # index in local files, built with python3 -m halpert.functions.wikipedia.util.embedded
+  backend: Literal['elasticsearch', 'embedded'] = 'elasticsearch'
+  host: str = 'http://localhost:9200'
+  index_name: str = 'wikipedia'
+  # connections to each node are kept alive and shared by all function calls
+  connections_per_node: int = 32
+  request_timeout: float = 10
+  embedded_dir: str = os.path.join(os.path.expanduser('~'), '.cache', 'halpert', 'wikipedia', 'embedded')
+  # postings of a term that are scored, highest impact first. the rest of the
+  # postings of frequent terms barely change the ranking
+  embedded_max_postings: int | None = 2000
+  # number of results of a search
+  search_size: int = 10
+  # maximum number of characters of the snippet of a search result
+  snippet_size: int = 300
+  # number of pages read_page keeps in memory
+  page_cache_size: int = 256
+  # maximum number of characters read_page_section reads when no section is given
+  section_length: int = 4000
+
+
+config = Config()
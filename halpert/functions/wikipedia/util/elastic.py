@@ -0,0 +1,109 @@
+import asyncio
+from elasticsearch import AsyncElasticsearch
+from typing import Dict, List
+from .backend import Backend
+from .config import config
+from .sections import split_sections
+
+
+# the substring is taken in elasticsearch, so only the part that is read is
+# sent. offsets are in code points, like python strings
+substring = '''
+  def markdown = params._source.markdown;
+  int count = markdown.codePointCount(0, markdown.length());
+  int start = markdown.offsetByCodePoints(0, (int) Math.min(params.start, count));
+  int end = markdown.offsetByCodePoints(0, (int) Math.min(Math.max(params.end, params.start), count));
+  return markdown.substring(start, end);
+'''
+
+
+class ElasticsearchBackend(Backend):
+  def __init__(self, host: str, index_name: str):
+    self.host = host
+    self.index_name = index_name
+    self._client: AsyncElasticsearch | None = None
+    self._client_loop: asyncio.AbstractEventLoop | None = None
+    # clients of earlier event loops, which are closed with this backend
+    self._replaced: List[AsyncElasticsearch] = []
+
+
+  @property
+  def client(self) -> AsyncElasticsearch:
+    # the client is shared by all function calls on the same event loop
+    loop = asyncio.get_running_loop()
+    if self._client is None or self._client_loop is not loop:
+      if self._client is not None:
+        self._replaced.append(self._client)
+      self._client = AsyncElasticsearch(
+        [self.host],
+        connections_per_node=config.connections_per_node,
+        request_timeout=config.request_timeout,
+      )
+      self._client_loop = loop
+    return self._client
+
+
+  async def _get(self, slug: str, **kwargs) -> Dict | None:
+    # slug is a keyword, so this only finds the page with exactly that slug
+    response = await self.client.search(index=self.index_name, query={
+      'term': { 'slug': slug },
+    }, size=1, **kwargs)
+    hits = response['hits']['hits']
+    return hits[0] if hits else None
+
+
+  async def search(self, query: str, size: int, snippet_size: int) -> List[Dict]:
+    # only the fields that results are built from are loaded, not the whole pages
+    response = await self.client.search(index=self.index_name, query={
+      'multi_match': {
+        'query': query,
+        'fields': ['title^2', 'text'],
+        # 'fields': ['title', 'text'],
+      },
+    }, highlight={
+      'fields': {
+        'text': { 'pre_tags': [''], 'post_tags': [''], 'fragment_size': snippet_size },
+      },
+    }, source=['slug', 'title', 'summary'], size=size)
+
+    return [{
+      'slug': hit['_source']['slug'],
+      'title': hit['_source']['title'],
+      'snippet': hit.get('highlight', {}).get('text', [hit['_source'].get('summary', '')[:snippet_size]])[0],
+    } for hit in response['hits']['hits']]
+
+
+  async def get_page(self, slug: str) -> Dict | None:
+    hit = await self._get(slug, source=['title', 'markdown'])
+    return hit['_source'] if hit else None
+
+
+  async def get_outline(self, slug: str) -> Dict | None:
+    # only the sections that were computed at index time are loaded, not the page
+    hit = await self._get(slug, source=['title', 'sections', 'length'])
+    if hit is None:
+      return None
+    if 'sections' not in hit['_source']:
+      # indexed without sections
+      page = await self.get_page(slug)
+      return {
+        'title': page['title'],
+        'length': len(page['markdown']),
+        'sections': split_sections(page['markdown'], page['title']),
+      }
+    return hit['_source']
+
+
+  async def get_range(self, slug: str, start: int, end: int) -> str | None:
+    hit = await self._get(slug, source=False, script_fields={
+      'content': { 'script': { 'source': substring, 'params': { 'start': start, 'end': end } } },
+    })
+    return hit['fields']['content'][0] if hit else None
+
+
+  async def close(self):
+    clients = self._replaced + ([self._client] if self._client is not None else [])
+    self._client = None
+    self._replaced = []
+    for client in clients:
+      await client.close()
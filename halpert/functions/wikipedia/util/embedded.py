@@ -0,0 +1,267 @@
+import os
+import re
+import sys
+import json
+import math
+import mmap
+import zlib
+import heapq
+import struct
+import asyncio
+import logging
+import argparse
+from array import array
+from collections import Counter, defaultdict
+from tqdm import tqdm
+from typing import Dict, Iterable, List, Tuple
+from .backend import Backend
+from .config import config
+from .sections import split_sections
+
+logger = logging.getLogger('halpert')
+
+
+# an index of pages in local files that are read through mmap, so that no
+# search service is needed and opening an index is free:
+#
+#   meta.json          page count and average field lengths
+#   pages.data         zlib compressed pages, as a head with what search results
+#                      and outlines need, followed by the markdown
+#   pages.index        offsets of the head and markdown of each page
+#   slugs.*            sorted table of slugs to pages
+#   terms.*            sorted table of field and term to their postings
+#   postings.pages     pages and bm25 scores of each term and field, highest
+#   postings.impacts   score first, so that only the best postings of frequent
+#                      terms need to be read
+version = 1
+# bm25 parameters and field boosts of the elasticsearch index
+k1 = 1.2
+b = 0.75
+fields = { 'title': 2.0, 'text': 1.0 }
+page_record = struct.Struct('<QIQI')
+table_record = struct.Struct('<QIQI')
+token = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+  return token.findall(text.lower())
+
+
+def map_file(path: str):
+  with open(path, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_table(path: str, entries: List[Tuple[bytes, int, int]]):
+  offset = 0
+  with open(f'{path}.keys', 'wb') as keys, open(f'{path}.index', 'wb') as index:
+    for key, value, count in sorted(entries):
+      keys.write(key)
+      index.write(table_record.pack(offset, len(key), value, count))
+      offset += len(key)
+
+
+class Table:
+  # sorted keys with two numbers each, looked up by binary search
+  def __init__(self, path: str):
+    self.keys = map_file(f'{path}.keys')
+    self.index = map_file(f'{path}.index')
+    self.count = len(self.index) // table_record.size
+
+
+  def get(self, key: bytes) -> Tuple[int, int] | None:
+    lower, upper = 0, self.count
+    while lower < upper:
+      middle = (lower + upper) // 2
+      offset, length, value, count = table_record.unpack_from(self.index, middle * table_record.size)
+      record_key = self.keys[offset:offset + length]
+      if record_key < key:
+        lower = middle + 1
+      elif record_key > key:
+        upper = middle
+      else:
+        return value, count
+    return None
+
+
+def build(pages: Iterable[Dict], dir: str):
+  os.makedirs(dir, exist_ok=True)
+  postings: Dict[str, Dict[str, Tuple[array, array]]] = { field: defaultdict(lambda: (array('I'), array('I'))) for field in fields }
+  lengths = { field: array('I') for field in fields }
+  slugs: List[Tuple[bytes, int, int]] = []
+
+  offset = 0
+  with open(os.path.join(dir, 'pages.data'), 'wb') as data, open(os.path.join(dir, 'pages.index'), 'wb') as index:
+    for page_id, page in enumerate(tqdm(pages, desc='Indexing')):
+      head = zlib.compress(json.dumps({
+        'slug': page['slug'],
+        'title': page['title'],
+        'length': len(page['markdown']),
+        'sections': split_sections(page['markdown'], page['title']),
+        'summary': page['summary'],
+      }).encode('utf-8'))
+      body = zlib.compress(page['markdown'].encode('utf-8'))
+      data.write(head)
+      data.write(body)
+      index.write(page_record.pack(offset, len(head), offset + len(head), len(body)))
+      offset += len(head) + len(body)
+      slugs.append((page['slug'].encode('utf-8'), page_id, 0))
+
+      for field in fields:
+        tokens = tokenize(page[field])
+        lengths[field].append(len(tokens))
+        for term, frequency in Counter(tokens).items():
+          term_pages, term_frequencies = postings[field][term]
+          term_pages.append(page_id)
+          term_frequencies.append(frequency)
+
+  count = len(slugs)
+  average_lengths = { field: sum(lengths[field]) / count if count else 0 for field in fields }
+  terms: List[Tuple[bytes, int, int]] = []
+  offset = 0
+  with open(os.path.join(dir, 'postings.pages'), 'wb') as pages_file, open(os.path.join(dir, 'postings.impacts'), 'wb') as impacts_file:
+    for field in fields:
+      field_lengths = lengths[field]
+      average_length = average_lengths[field] or 1
+      for term, (term_pages, term_frequencies) in tqdm(postings[field].items(), desc=f'Writing {field} postings'):
+        idf = math.log(1 + (count - len(term_pages) + 0.5) / (len(term_pages) + 0.5))
+        impacts = [
+          idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * field_lengths[page_id] / average_length))
+          for page_id, frequency in zip(term_pages, term_frequencies)
+        ]
+        order = sorted(range(len(impacts)), key=lambda i: -impacts[i])
+        pages_file.write(array('I', [term_pages[i] for i in order]).tobytes())
+        impacts_file.write(array('f', [impacts[i] for i in order]).tobytes())
+        terms.append((f'{field}:{term}'.encode('utf-8'), offset, len(order)))
+        offset += len(order)
+
+  write_table(os.path.join(dir, 'terms'), terms)
+  write_table(os.path.join(dir, 'slugs'), slugs)
+  with open(os.path.join(dir, 'meta.json'), 'w') as f:
+    json.dump({
+      'version': version,
+      # arrays are written in the byte order of the machine that built them
+      'byteorder': sys.byteorder,
+      'count': count,
+      'average_lengths': average_lengths,
+    }, f)
+  logger.info(f'Indexed {count} pages and {len(terms)} terms to {dir}')
+
+
+class EmbeddedBackend(Backend):
+  def __init__(self, dir: str):
+    meta_path = os.path.join(dir, 'meta.json')
+    if not os.path.exists(meta_path):
+      raise ValueError(f'No index in {dir}, build one with python3 -m halpert.functions.wikipedia.util.embedded')
+    with open(meta_path, 'r') as f:
+      meta = json.load(f)
+    if meta['version'] != version or meta['byteorder'] != sys.byteorder:
+      raise ValueError(f'Index in {dir} was built by another version or on another platform, rebuild it')
+
+    self.dir = dir
+    self.count = meta['count']
+    self.pages = map_file(os.path.join(dir, 'pages.data'))
+    self.page_index = map_file(os.path.join(dir, 'pages.index'))
+    self.slugs = Table(os.path.join(dir, 'slugs'))
+    self.terms = Table(os.path.join(dir, 'terms'))
+    self.posting_pages = memoryview(map_file(os.path.join(dir, 'postings.pages'))).cast('I')
+    self.posting_impacts = memoryview(map_file(os.path.join(dir, 'postings.impacts'))).cast('f')
+
+
+  def _page_id(self, slug: str) -> int | None:
+    entry = self.slugs.get(slug.encode('utf-8'))
+    return entry[0] if entry else None
+
+
+  def _head(self, page_id: int) -> Dict:
+    offset, length, _, _ = page_record.unpack_from(self.page_index, page_id * page_record.size)
+    return json.loads(zlib.decompress(self.pages[offset:offset + length]))
+
+
+  def _markdown(self, page_id: int) -> str:
+    _, _, offset, length = page_record.unpack_from(self.page_index, page_id * page_record.size)
+    return zlib.decompress(self.pages[offset:offset + length]).decode('utf-8')
+
+
+  def score(self, query: str, size: int) -> List[Tuple[int, float]]:
+    terms = tokenize(query)
+    best: Dict[int, float] = {}
+    for field, boost in fields.items():
+      scores: Dict[int, float] = defaultdict(float)
+      for term in terms:
+        entry = self.terms.get(f'{field}:{term}'.encode('utf-8'))
+        if entry is None:
+          continue
+        offset, count = entry
+        if config.embedded_max_postings is not None:
+          count = min(count, config.embedded_max_postings)
+        for page_id, impact in zip(self.posting_pages[offset:offset + count], self.posting_impacts[offset:offset + count]):
+          scores[page_id] += impact
+      # a page scores as its best field, like the best_fields multi_match query
+      for page_id, score in scores.items():
+        score *= boost
+        if score > best.get(page_id, 0):
+          best[page_id] = score
+    return heapq.nlargest(size, best.items(), key=lambda item: (item[1], -item[0]))
+
+
+  async def search(self, query: str, size: int, snippet_size: int) -> List[Dict]:
+    terms = set(tokenize(query))
+    results = []
+    for page_id, _ in self.score(query, size):
+      head = self._head(page_id)
+      results.append({
+        'slug': head['slug'],
+        'title': head['title'],
+        'snippet': snippet(head['summary'], terms, snippet_size),
+      })
+    return results
+
+
+  async def get_page(self, slug: str) -> Dict | None:
+    page_id = self._page_id(slug)
+    if page_id is None:
+      return None
+    return { 'title': self._head(page_id)['title'], 'markdown': self._markdown(page_id) }
+
+
+  async def get_outline(self, slug: str) -> Dict | None:
+    page_id = self._page_id(slug)
+    return self._head(page_id) if page_id is not None else None
+
+
+  async def get_range(self, slug: str, start: int, end: int) -> str | None:
+    page_id = self._page_id(slug)
+    return self._markdown(page_id)[start:end] if page_id is not None else None
+
+
+def snippet(summary: str, terms: set, size: int) -> str:
+  # starts at the first word of the summary that was searched for, if any
+  for match in token.finditer(summary):
+    if match.group().lower() in terms:
+      start = summary.rfind(' ', 0, max(match.start() - size // 4, 0)) + 1
+      return summary[start:start + size]
+  return summary[:size]
+
+
+async def main():
+  from datasets import load_dataset
+  from .index import summary_length
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--dataset', type=str, default='davidfant/wikipedia-simple')
+  parser.add_argument('--output', type=str, default=config.embedded_dir)
+  parser.add_argument('--limit', type=int)
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  dataset = load_dataset(args.dataset)['train']
+  if args.limit:
+    dataset = dataset.select(range(args.limit))
+  build(({ **sample, 'summary': sample['text'][:summary_length] } for sample in dataset), args.output)
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -6,15 +6,25 @@ from tqdm import tqdm
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 from datasets import load_dataset, Dataset
+from .sections import split_sections
 
 logger = logging.getLogger('halpert')
 
+summary_length = 1000
+
 def generate_data(dataset: Dataset, index_name: str):
   for sample in tqdm(dataset, desc='Indexing'):
     yield {
       "_index": index_name,
       "_id": sample['id'],
-      "_source": sample
+      "_source": {
+        **sample,
+        # sections are computed here, so that reading a section only loads its part of the page
+        'sections': split_sections(sample['markdown'], sample['title']),
+        'length': len(sample['markdown']),
+        # snippet of search results that have no highlight
+        'summary': sample['text'][:summary_length],
+      },
     }
 
 async def main(index_name: str = 'wikipedia', host: str = 'http://localhost:9200'):
@@ -24,10 +34,13 @@ async def main(index_name: str = 'wikipedia', host: str = 'http://localhost:9200
     'mappings': {
       'properties': {
         'id': { 'type': 'keyword' },
-        'slug': { 'type': 'text' },
+        'slug': { 'type': 'keyword' },
         'title': { 'type': 'text' },
         'markdown': { 'type': 'text' },
-        'text': { 'type': 'text' }
+        'text': { 'type': 'text' },
+        'sections': { 'type': 'object', 'enabled': False },
+        'length': { 'type': 'integer' },
+        'summary': { 'type': 'text', 'index': False },
       }
     }
   }
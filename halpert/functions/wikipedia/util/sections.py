@@ -0,0 +1,23 @@
+import re
+from typing import Dict, List
+
+
+heading = re.compile(r'^(#{1,6})[ \t]+(.*?)[ \t]*#*[ \t]*$', re.MULTILINE)
+
+
+def split_sections(markdown: str, title: str = '') -> List[Dict]:
+  # splits a page at its headings. the text before the first heading is a
+  # section with the title of the page, and offsets are in characters
+  matches = list(heading.finditer(markdown))
+  sections = []
+  intro_end = matches[0].start() if matches else len(markdown)
+  if markdown[:intro_end].strip():
+    sections.append({ 'title': title, 'level': 0, 'start': 0, 'end': intro_end })
+  for i, match in enumerate(matches):
+    sections.append({
+      'title': match.group(2),
+      'level': len(match.group(1)),
+      'start': match.start(),
+      'end': matches[i + 1].start() if i + 1 < len(matches) else len(markdown),
+    })
+  return sections
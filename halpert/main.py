@@ -1,91 +1,343 @@
-import arrow
+import os
+import json
+import time
+import asyncio
 import logging
+from contextvars import ContextVar
 from tabulate import tabulate
-from pydantic import BaseModel, Field
-from typing import Dict, List
-from .types import Sample, OdooSample, Function
+from pydantic import BaseModel, Field, ValidationError, root_validator
+from typing import Any, Dict, List, Tuple
+from .types import Sample, OdooSample, Function, FunctionCall, Usage
+from .util import clock
 
 
 logger = logging.getLogger(__name__)
 
+# the calls made while this is set are added to it as well, so that a runner
+# can mark the calls of an agent step it throws away as discarded
+recorded_calls: ContextVar[List[FunctionCall] | None] = ContextVar('recorded_calls', default=None)
 
-def monkey_patch_function_call(function: Function, sample_idx: int, halpert: 'Halpert'):
-  original_call = function.call
-  def call(*args, **kwargs):
-    if not sample_idx in halpert.sample_functions_:
-      halpert.sample_functions_[sample_idx] = []
-    halpert.sample_functions_[sample_idx].append(function.slug)
 
-    return original_call(*args, **kwargs)
+def monkey_patch_function_call(function: Function, sample: Sample, result: 'Halpert.Result', cache: bool = False):
+  if cache:
+    from halpert.util.openai import create_hash, load_value, save_value
+
+  original_call = function.call
+  async def call(input: BaseModel, *args, **kwargs):
+    record = FunctionCall(function=function.slug, start=time.time(), input_size=len(input.json()))
+    # calls are keyed by their position in the run, so that the outputs of
+    # functions that depend on earlier calls are replayed in the same order
+    key = create_hash('function', sample.id, result.model, len(result.calls), function.slug, input.json()) if cache else None
+    result.calls.append(record)
+    if (recorded := recorded_calls.get()) is not None:
+      recorded.append(record)
+    started = time.perf_counter()
+    try:
+      if key and (entry := load_value(key)) is not None:
+        output = function.Output.parse_obj(entry.value)
+        record.cached = True
+      else:
+        with clock.frozen(sample.date):
+          output = await original_call(input, *args, **kwargs)
+        if key:
+          save_value(key, output.dict(), time.perf_counter() - started)
+      record.output_size = len(output.json())
+      return output
+    except asyncio.CancelledError:
+      record.cancelled = True
+      raise
+    except BaseException as e:
+      record.error = f'{type(e).__name__}: {e}'
+      raise
+    finally:
+      record.latency = time.perf_counter() - started
+      record.end = record.start + record.latency
   function.call = call
 
 
+def percentile(values: List[float], q: float) -> float:
+  values = sorted(values)
+  position = (len(values) - 1) * q
+  lower = int(position)
+  upper = min(lower + 1, len(values) - 1)
+  return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
 class Halpert(BaseModel):
+  class Result(BaseModel):
+    sample: str
+    model: str | None = None
+    calls: List[FunctionCall] = Field(default_factory=list)
+    quiz: List[Sample.Evaluation.QuizItem] | None = None
+    usage: Usage | None = None
+
   samples: List[Sample]
   odoo_snapshot_dir: str | None = None
+  journal_path: str | None = None
+  # serve function outputs from the completion cache, so that cached runs can be replayed offline
+  cache_functions: bool = False
+
+  samples_by_id_: Dict[str, Sample] = Field(default_factory=dict)
+  # the samples as they were passed in, which are copied on validation, and
+  # the samples they became, so that callers can keep using their own samples
+  given_samples_: List[Any] = Field(default_factory=list)
+  samples_by_given_: Dict[int, Tuple[Any, Sample]] = Field(default_factory=dict)
+  results_: Dict[Tuple[str, str | None], Result] = Field(default_factory=dict)
+
+
+  @root_validator(pre=True)
+  def keep_given_samples(cls, values):
+    values['given_samples_'] = list(values.get('samples') or [])
+    return values
+
+
+  @root_validator(skip_on_failure=True)
+  def assign_sample_ids(cls, values):
+    samples: List[Sample] = []
+    samples_by_id: Dict[str, Sample] = {}
+    for sample in values['samples']:
+      if sample.id is None:
+        # samples without an explicit id are identified by their name, and
+        # samples with the same name by the order they appear in
+        sample_id = sample.slug
+        count = 1
+        while sample_id in samples_by_id:
+          count += 1
+          sample_id = f'{sample.slug}_{count}'
+        sample = sample.copy(update={ 'id': sample_id })
+      elif sample.id in samples_by_id:
+        raise ValueError(f'Duplicate sample id: {sample.id}')
+      samples.append(sample)
+      samples_by_id[sample.id] = sample
+    values['samples'] = samples
+    values['samples_by_id_'] = samples_by_id
+    values['samples_by_given_'] = { id(given): (given, sample) for given, sample in zip(values['given_samples_'], samples) }
+    return values
 
-  sample_functions_: Dict[int, List[str]] = Field(default_factory=dict)
-  sample_quiz_: Dict[int, List[Sample.Evaluation.QuizItem]] = Field(default_factory=dict)
 
+  def sample(self, id: str | None) -> Sample:
+    if id is None:
+      raise ValueError('Sample has no id, use the samples Halpert was created with or those from Halpert.samples')
+    if id not in self.samples_by_id_:
+      raise ValueError(f'Unknown sample: {id}')
+    return self.samples_by_id_[id]
 
-  def prepare(self, sample: Sample) -> List[Function]:
+
+  def find(self, sample: Sample) -> Sample:
+    # samples without an id are those that were passed in, found by identity
+    if sample.id is None and (entry := self.samples_by_given_.get(id(sample))) and entry[0] is sample:
+      return entry[1]
+    return self.sample(sample.id)
+
+
+  def shard(self, index: int, count: int) -> List[Sample]:
+    if not 0 <= index < count:
+      raise ValueError(f'Invalid shard {index}/{count}')
+    return self.samples[index::count]
+
+
+  def prepare(self, sample: Sample, model: str | None = None) -> List[Function]:
+    self.prepare_environment(sample)
+    return self.instrument(sample, model)
+
+
+  def prepare_environment(self, sample: Sample):
     if isinstance(sample, OdooSample):
       from halpert.functions.odoo.snapshot.restore import restore as restore_odoo_snapshot
 
       if not self.odoo_snapshot_dir:
         raise ValueError('odoo_snapshot_dir must be set when using OdooSample')
       restore_odoo_snapshot(sample.snapshot, self.odoo_snapshot_dir)
-    
-    def utcnow():
-      return arrow.get(sample.date)
-    arrow.utcnow = utcnow
 
-    idx = self.samples.index(sample)
-    functions = [Function(**f.dict()) for f in sample.functions]
+    clock.date.set(sample.date)
+
+
+  def instrument(self, sample: Sample, model: str | None = None) -> List[Function]:
+    sample = self.find(sample)
+    result = self.results_[(sample.id, model)] = Halpert.Result(sample=sample.id, model=model)
+    functions = [
+      Function(**{ **f.dict(), 'call': f.create_call() if f.create_call else f.call })
+      for f in sample.functions
+    ]
     for f in functions:
-      monkey_patch_function_call(f, idx, self)
+      monkey_patch_function_call(f, sample, result, self.cache_functions)
     return functions
 
 
-  def submit(self, sample: Sample, quiz: List[Sample.Evaluation.QuizItem]):
-    idx = self.samples.index(sample)
-    self.sample_quiz_[idx] = quiz
+  def submit(
+    self,
+    sample: Sample,
+    quiz: List[Sample.Evaluation.QuizItem],
+    model: str | None = None,
+    usage: Usage | None = None,
+  ):
+    result = self.results_[(self.find(sample).id, model)]
+    result.quiz = quiz
+    result.usage = usage
+    if self.journal_path:
+      with open(self.journal_path, 'a+b') as f:
+        # the last line is incomplete if a run was interrupted while writing
+        # it, and is cut off so that this result doesn't end up on the same line
+        if f.seek(0, os.SEEK_END) > 0:
+          f.seek(-1, os.SEEK_END)
+          if f.read(1) != b'\n':
+            f.seek(0)
+            f.truncate(f.read().rfind(b'\n') + 1)
+        f.write((result.json() + '\n').encode('utf-8'))
+
+
+  def completed(self, sample: Sample, model: str | None = None) -> bool:
+    if sample.id is None:
+      sample = self.find(sample)
+    result = self.results_.get((sample.id, model))
+    return result is not None and result.quiz is not None
+
+
+  def resume(self):
+    if self.journal_path and os.path.exists(self.journal_path):
+      self.load(self.journal_path)
+      logger.info(f'Resumed {len(self.results_)} completed samples from {self.journal_path}')
+
+
+  def save(self, path: str):
+    with open(path, 'w') as f:
+      for result in self.results_.values():
+        if result.quiz is not None:
+          f.write(result.json() + '\n')
+
+
+  def load(self, path: str):
+    with open(path, 'r') as f:
+      for line in f:
+        try:
+          result = Halpert.Result.parse_raw(line)
+        except ValidationError:
+          # the last line can be incomplete if a run was interrupted while writing it
+          logger.warning(f'Skipping invalid result in {path}: {line.strip()}')
+          continue
+        self.results_[(self.sample(result.sample).id, result.model)] = result
+
+
+  def export_trace(self, path: str):
+    # chrome trace event format, which can be opened in chrome://tracing or https://ui.perfetto.dev
+    events = []
+    for tid, result in enumerate(self.results_.values()):
+      name = result.sample if result.model is None else f'{result.sample} ({result.model})'
+      events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': { 'name': name } })
+      for call in result.calls:
+        if call.latency is None:
+          continue
+        events.append({
+          'name': call.function,
+          'cat': 'function',
+          'ph': 'X',
+          'pid': 0,
+          'tid': tid,
+          'ts': call.start * 1e6,
+          'dur': call.latency * 1e6,
+          'args': {
+            'sample': result.sample,
+            'model': result.model,
+            'input_size': call.input_size,
+            'output_size': call.output_size,
+            'cached': call.cached,
+            'error': call.error,
+            'cancelled': call.cancelled,
+          },
+        })
+    with open(path, 'w') as f:
+      json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
 
 
   def evaluate(self):
-    assert list(range(len(self.samples))) == sorted(self.sample_functions_.keys())
-    assert list(range(len(self.samples))) == sorted(self.sample_quiz_.keys())
-    
+    models = list(dict.fromkeys(model for _, model in self.results_)) or [None]
+    missing = [(s.id, m) for m in models for s in self.samples if not self.completed(s, m)]
+    assert not missing, f'Missing results for samples: {missing}'
+
     quiz_answers = []
     results = []
-    for index, sample in enumerate(self.samples):
-      function_slugs_called = self.sample_functions_[index]
-      quiz = self.sample_quiz_[index]
-
-      quiz_answers_correct = [
-        expected.answer == (quiz[i].answer if i < len(quiz) else False)
-        for i, expected in enumerate(sample.expected.quiz)
-      ]
-      quiz_answers.extend([{
-        'Sample': sample.name,
-        'Question': expected.question,
-        'Expected': expected.answer,
-        'Actual': quiz[i].answer if i < len(quiz) else '',
-        'Correct': quiz_answers_correct[i],
-      } for i, expected in enumerate(sample.expected.quiz)])
+    results_by_sample: Dict[Tuple[str, str | None], Dict] = {}
+    calls: Dict[str, List[FunctionCall]] = {}
+    for model in models:
+      for sample in self.samples:
+        result = self.results_[(sample.id, model)]
+        function_slugs_called = [c.function for c in result.calls if not c.discarded]
+        for call in result.calls:
+          calls.setdefault(call.function, []).append(call)
+        quiz = result.quiz
 
-      expected_functions_used = set(function_slugs_called) & set(sample.expected.functions)
+        quiz_answers_correct = [
+          expected.answer == (quiz[i].answer if i < len(quiz) else False)
+          for i, expected in enumerate(sample.expected.quiz)
+        ]
+        quiz_answers.extend([{
+          'Sample': sample.name,
+          'Model': model,
+          'Question': expected.question,
+          'Expected': expected.answer,
+          'Actual': quiz[i].answer if i < len(quiz) else '',
+          'Correct': quiz_answers_correct[i],
+        } for i, expected in enumerate(sample.expected.quiz)])
+
+        expected_functions_used = set(function_slugs_called) & set(sample.expected.functions)
+
+        results.append({
+          'Sample': sample.name,
+          'Model': model,
+          'Quiz Score': sum(quiz_answers_correct) / len(quiz_answers_correct),
+          'Functions Score': len(expected_functions_used) / len(sample.expected.functions),
+          'Steps': len(function_slugs_called),
+          # completions of the agent loop, which is what the steps budget limits
+          'Agent Steps': result.usage.steps if result.usage else None,
+          'Tokens': result.usage.prompt_tokens + result.usage.completion_tokens if result.usage else None,
+          'Seconds': result.usage.seconds if result.usage else None,
+          'Budget Exhausted': result.usage.exhausted if result.usage else None,
+        })
+        results_by_sample[(sample.id, model)] = results[-1]
+
+    if len(models) == 1:
+      for row in quiz_answers + results:
+        del row['Model']
 
-      results.append({
-        'Sample': sample.name,
-        'Quiz Score': sum(quiz_answers_correct) / len(quiz_answers_correct),
-        'Functions Score': len(expected_functions_used) / len(sample.expected.functions),
-        'Steps': len(function_slugs_called),
-      })
-    
     table = tabulate({ k: [r[k] for r in quiz_answers] for k in quiz_answers[0].keys() }, headers='keys')
     logger.info('Quiz Answers:\n' + table)
 
     table = tabulate({ k: [r[k] for r in results] for k in results[0].keys() }, headers='keys')
     logger.info('Evaluation:\n' + table)
 
+    if len(models) > 1:
+      comparison = [{
+        'Sample': sample.name,
+        **{ model: results_by_sample[(sample.id, model)]['Quiz Score'] for model in models },
+      } for sample in self.samples]
+      comparison.append({
+        'Sample': 'Mean Quiz Score',
+        **{ model: sum(r['Quiz Score'] for r in results if r['Model'] == model) / len(self.samples) for model in models },
+      })
+      comparison.append({
+        'Sample': 'Mean Functions Score',
+        **{ model: sum(r['Functions Score'] for r in results if r['Model'] == model) / len(self.samples) for model in models },
+      })
+      table = tabulate({ k: [r[k] for r in comparison] for k in comparison[0].keys() }, headers='keys')
+      logger.info('Model Comparison:\n' + table)
+
+    latencies = []
+    for function, function_calls in sorted(calls.items()):
+      # cancelled calls didn't run to the end, so their latencies aren't counted
+      timed = [c for c in function_calls if c.latency is not None and not c.cancelled]
+      if not timed and not any(c.cancelled for c in function_calls):
+        continue
+      latencies.append({
+        'Function': function,
+        'Calls': len(function_calls),
+        'Errors': sum(c.error is not None for c in function_calls),
+        'Cancelled': sum(c.cancelled for c in function_calls),
+        'p50 (ms)': percentile([c.latency for c in timed], 0.5) * 1000 if timed else None,
+        'p95 (ms)': percentile([c.latency for c in timed], 0.95) * 1000 if timed else None,
+        'Max (ms)': max(c.latency for c in timed) * 1000 if timed else None,
+        'Avg Input (bytes)': sum(c.input_size for c in function_calls) / len(function_calls),
+        'Avg Output (bytes)': sum(c.output_size or 0 for c in function_calls) / len(function_calls),
+      })
+    if latencies:
+      table = tabulate({ k: [r[k] for r in latencies] for k in latencies[0].keys() }, headers='keys', floatfmt='.1f')
+      logger.info('Function Latency:\n' + table)
@@ -0,0 +1,99 @@
+import re
+import json
+import logging
+from pydantic import BaseModel
+from typing import Callable, Dict, List
+from .types import Function
+
+ChatCompletionToolParam = Dict
+ChatCompletionMessageParam = Dict
+
+logger = logging.getLogger(__name__)
+
+# outputs of earlier steps that were already compacted
+truncated = re.compile(r'\.\.\. \(\d+ characters truncated\)$')
+removed = '(removed to fit the context)'
+
+
+def estimate_tokens(message: ChatCompletionMessageParam) -> int:
+  return len(json.dumps(message)) // 4
+
+
+def tool(function: Function) -> ChatCompletionToolParam:
+  return {
+    'type': 'function',
+    'function': {
+      'name': function.slug,
+      'description': function.description,
+      'parameters': function.Input.schema(),
+    },
+  }
+
+
+class ToolRegistry:
+  functions: Dict[str, Function]
+  validators: Dict[str, Callable[[str], BaseModel]]
+  tools: List[ChatCompletionToolParam]
+
+
+  def __init__(self, functions: List[Function], tools: List[ChatCompletionToolParam] = []):
+    self.functions = {}
+    for f in functions:
+      if f.slug in self.functions:
+        raise ValueError(f'Duplicate function: {f.slug}')
+      self.functions[f.slug] = f
+    self.validators = { f.slug: f.Input.parse_raw for f in functions }
+    self.tools = [tool(f) for f in functions] + tools
+
+
+  def get(self, slug: str) -> Function | None:
+    return self.functions.get(slug)
+
+
+  def parse(self, slug: str, arguments: str) -> BaseModel:
+    return self.validators[slug](arguments)
+
+
+  def compact(self, messages: List[ChatCompletionMessageParam], max_tokens: int) -> List[ChatCompletionMessageParam]:
+    # truncates the outputs of earlier steps, oldest first, until the
+    # conversation fits in max_tokens, and removes them once truncating all of
+    # them isn't enough. the outputs of the last step are kept whole, and so
+    # are the outputs of functions without compact_tokens. messages are
+    # replaced rather than mutated, so that conversation hashes stay correct
+    tokens = sum(estimate_tokens(m) for m in messages)
+    if tokens <= max_tokens:
+      return messages
+
+    last_step = max((i for i, m in enumerate(messages) if m['role'] == 'assistant'), default=len(messages))
+    names = {
+      tc['id']: tc['function']['name']
+      for m in messages[:last_step] if m['role'] == 'assistant'
+      for tc in m.get('tool_calls') or []
+    }
+    compacted = list(messages)
+    for removing in (False, True):
+      for i, message in enumerate(compacted[:last_step]):
+        if tokens <= max_tokens:
+          return compacted
+        if message['role'] != 'tool':
+          continue
+
+        fn = self.get(names.get(message['tool_call_id'], ''))
+        if fn is None or fn.compact_tokens is None:
+          continue
+        content = message['content']
+        if removing:
+          # the message itself is kept, as every tool call needs an output
+          replacement = removed
+        elif truncated.search(content) is None:
+          length = fn.compact_tokens * 4
+          replacement = f'{content[:length]}... ({len(content) - length} characters truncated)'
+        else:
+          continue
+        if len(replacement) >= len(content):
+          continue
+        compacted[i] = { **message, 'content': replacement }
+        tokens -= estimate_tokens(message) - estimate_tokens(compacted[i])
+
+    logger.warning(f'Conversation of {tokens} tokens does not fit in {max_tokens} tokens after removing the outputs of earlier steps')
+    return compacted
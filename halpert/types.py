@@ -7,17 +7,57 @@ class Function(BaseModel, ABC):
   name: str
   description: str
   icon: str | None = None
+  # calls to functions that mutate state are never run concurrently with other calls
+  mutates: bool = False
+  # outputs of earlier steps are truncated to this many tokens when the
+  # conversation gets too long, or never truncated when not set
+  compact_tokens: int | None = 256
 
   Input: Type[BaseModel]
   Output: Type[BaseModel]
 
   call: Callable[['Function.Input'], Awaitable['Function.Output']]
+  # creates a new call for every run, for functions that keep state between
+  # calls, so that each run starts from the same state
+  create_call: Callable[[], Callable[['Function.Input'], Awaitable['Function.Output']]] | None = None
 
   @property
   def slug(self):
     return self.name.lower().replace(' ', '_')
 
 
+class FunctionCall(BaseModel):
+  function: str
+  start: float
+  end: float | None = None
+  latency: float | None = None
+  input_size: int
+  output_size: int | None = None
+  cached: bool = False
+  error: str | None = None
+  # stopped before it returned, e.g. by the time budget or because its step was thrown away
+  cancelled: bool = False
+  # made in an agent step that was thrown away, e.g. because its completion was cut off
+  discarded: bool = False
+
+
+class Budget(BaseModel):
+  # limits of the agent loop of a sample, unlimited when not set
+  steps: int | None = None
+  prompt_tokens: int | None = None
+  completion_tokens: int | None = None
+  seconds: float | None = None
+
+
+class Usage(BaseModel):
+  steps: int = 0
+  prompt_tokens: int = 0
+  completion_tokens: int = 0
+  seconds: float = 0
+  # the budget that ran out before the agent was done, if any
+  exhausted: str | None = None
+
+
 class Sample(BaseModel):
   class Evaluation(BaseModel):
     class QuizItem(BaseModel):
@@ -27,14 +67,25 @@ class Sample(BaseModel):
     functions: List[str]
     quiz: List[QuizItem]
 
+  id: str | None = None
   name: str
   instructions: str
   date: str = '2023-11-26'
+  # overrides the budget the sample is run with
+  budget: Budget | None = None
   functions: List[Function]
   expected: Evaluation
   Input: Type[BaseModel] | None = None
   input: BaseModel | None = None
 
+  @property
+  def slug(self):
+    return self.name.lower().replace(' ', '_')
+
+  @property
+  def read_only(self):
+    return not any(f.mutates for f in self.functions)
+
 
 class OdooSample(Sample):
   snapshot: str
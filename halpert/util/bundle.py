@@ -0,0 +1,129 @@
+import os
+import json
+import mmap
+import zlib
+import struct
+import hashlib
+import tempfile
+from typing import Dict, Iterator, List, Tuple
+from .cache import Cache, CacheEntry
+
+
+# a bundle is a single file of cache entries that is read through mmap:
+#
+#   header  magic, version, entry count, index offset
+#   data    zlib compressed json values, stored once per distinct content
+#   index   one fixed size record per key, sorted by key, so lookups are a
+#           binary search over the mapped file and opening a bundle is free
+magic = b'HALPERTB'
+version = 1
+header = struct.Struct('<8sIIQ')
+record = struct.Struct('<32sQId')
+key_size = 32
+
+
+class BundleWriter:
+  def __init__(self, path: str):
+    self.path = path
+    self.file = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), delete=False)
+    self.file.write(b'\0' * header.size)
+    self.offset = header.size
+    self.blobs: Dict[str, Tuple[int, int]] = {}
+    self.entries: Dict[bytes, Tuple[int, int, float]] = {}
+
+
+  def add(self, key: str, value: Dict, latency: float | None = None):
+    encoded_key = key.encode('ascii')
+    if len(encoded_key) != key_size:
+      raise ValueError(f'Bundle keys must be {key_size} characters: {key}')
+
+    data = zlib.compress(json.dumps(value, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+    digest = hashlib.sha256(data).hexdigest()
+    if digest not in self.blobs:
+      self.file.write(data)
+      self.blobs[digest] = (self.offset, len(data))
+      self.offset += len(data)
+    offset, length = self.blobs[digest]
+    self.entries[encoded_key] = (offset, length, latency if latency is not None else float('nan'))
+
+
+  def close(self):
+    for key in sorted(self.entries):
+      self.file.write(record.pack(key, *self.entries[key]))
+    self.file.seek(0)
+    self.file.write(header.pack(magic, version, len(self.entries), self.offset))
+    self.file.close()
+    # temporary files are only readable by their owner
+    os.chmod(self.file.name, 0o644)
+    os.replace(self.file.name, self.path)
+
+
+  def __enter__(self) -> 'BundleWriter':
+    return self
+
+
+  def __exit__(self, type, value, traceback):
+    if type is None:
+      self.close()
+    else:
+      self.file.close()
+      os.remove(self.file.name)
+
+
+class Bundle(Cache):
+  def __init__(self, path: str):
+    self.path = path
+    with open(path, 'rb') as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    file_magic, file_version, self.count, self.index_offset = header.unpack_from(self.mm, 0)
+    if file_magic != magic or file_version != version:
+      raise ValueError(f'Not a version {version} bundle: {path}')
+
+
+  def _record(self, index: int) -> Tuple[bytes, int, int, float]:
+    return record.unpack_from(self.mm, self.index_offset + index * record.size)
+
+
+  def _entry(self, offset: int, length: int, latency: float) -> CacheEntry:
+    return CacheEntry(
+      value=json.loads(zlib.decompress(self.mm[offset:offset + length])),
+      size=length,
+      latency=None if latency != latency else latency,
+    )
+
+
+  def get(self, key: str) -> CacheEntry | None:
+    encoded_key = key.encode('ascii')
+    lower, upper = 0, self.count
+    while lower < upper:
+      middle = (lower + upper) // 2
+      record_key, offset, length, latency = self._record(middle)
+      if record_key < encoded_key:
+        lower = middle + 1
+      elif record_key > encoded_key:
+        upper = middle
+      else:
+        return self._entry(offset, length, latency)
+    return None
+
+
+  def set(self, key: str, value: Dict, latency: float | None = None):
+    raise TypeError('Bundles are read-only')
+
+
+  def keys(self) -> List[str]:
+    return [self._record(index)[0].decode('ascii') for index in range(self.count)]
+
+
+  def __len__(self) -> int:
+    return self.count
+
+
+  def __iter__(self) -> Iterator[Tuple[str, CacheEntry]]:
+    for index in range(self.count):
+      key, offset, length, latency = self._record(index)
+      yield key.decode('ascii'), self._entry(offset, length, latency)
+
+
+  def close(self):
+    self.mm.close()
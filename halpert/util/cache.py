@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pydantic import BaseModel
+from typing import Dict, Iterator, List
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(BaseModel):
+  value: Dict
+  # bytes read from storage
+  size: int
+  # seconds it took to create the value, if known
+  latency: float | None = None
+
+
+class Cache(ABC):
+  @abstractmethod
+  def get(self, key: str) -> CacheEntry | None:
+    ...
+
+  @abstractmethod
+  def set(self, key: str, value: Dict, latency: float | None = None):
+    ...
+
+  @abstractmethod
+  def keys(self) -> List[str]:
+    ...
+
+
+class FileCache(Cache):
+  def __init__(self, dir: str):
+    self.dir = dir
+
+
+  def get_path(self, key: str) -> str:
+    return os.path.join(self.dir, f'{key}.json')
+
+
+  def get(self, key: str) -> CacheEntry | None:
+    path = self.get_path(key)
+    if not os.path.exists(path):
+      return None
+    logger.info(f'Loading from cache: {path}')
+    with open(path, 'r') as f:
+      data = f.read()
+    return CacheEntry(value=json.loads(data), size=len(data))
+
+
+  def keys(self) -> List[str]:
+    if not os.path.exists(self.dir):
+      return []
+    return [name[:-len('.json')] for name in os.listdir(self.dir) if name.endswith('.json')]
+
+
+  def set(self, key: str, value: Dict, latency: float | None = None):
+    os.makedirs(self.dir, exist_ok=True)
+    # write to a temporary file and move it in place, so concurrent readers never see a partial file
+    fd, temp_path = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(value, f, indent=2)
+    os.replace(temp_path, self.get_path(key))
+
+
+class SQLiteCache(Cache):
+  # how long a read may go without refreshing the entry's access time, so
+  # that reads of hot entries don't all turn into writes
+  access_resolution = 60
+  # when evicting, free space down to this fraction of max_size, so that
+  # not every write after reaching the cap has to evict
+  evict_to = 0.9
+
+
+  def __init__(self, path: str, max_size: int | None = None, fallback: Cache | None = None):
+    self.path = path
+    self.max_size = max_size
+    self.fallback = fallback
+    self._lock = threading.Lock()
+    self._db: sqlite3.Connection | None = None
+    self._pid: int | None = None
+
+
+  @property
+  def db(self) -> sqlite3.Connection:
+    # connections can't be shared with forked worker processes
+    if self._db is None or self._pid != os.getpid():
+      os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+      db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+      db.execute('PRAGMA journal_mode=WAL')
+      db.execute('PRAGMA synchronous=NORMAL')
+      db.execute('''
+        CREATE TABLE IF NOT EXISTS entries (
+          key TEXT PRIMARY KEY,
+          value BLOB NOT NULL,
+          size INTEGER NOT NULL,
+          created REAL NOT NULL,
+          accessed REAL NOT NULL,
+          latency REAL
+        )
+      ''')
+      if 'latency' not in [column[1] for column in db.execute('PRAGMA table_info(entries)')]:
+        db.execute('ALTER TABLE entries ADD COLUMN latency REAL')
+      db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+      db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+      db.execute("INSERT OR IGNORE INTO meta (key, value) SELECT 'size', COALESCE(SUM(size), 0) FROM entries")
+      self._db = db
+      self._pid = os.getpid()
+    return self._db
+
+
+  @contextmanager
+  def transaction(self) -> Iterator[sqlite3.Connection]:
+    with self._lock:
+      db = self.db
+      db.execute('BEGIN IMMEDIATE')
+      try:
+        yield db
+        db.execute('COMMIT')
+      except BaseException:
+        db.execute('ROLLBACK')
+        raise
+
+
+  @property
+  def size(self) -> int:
+    with self._lock:
+      return self.db.execute("SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+
+
+  def keys(self) -> List[str]:
+    with self._lock:
+      keys = [key for key, in self.db.execute('SELECT key FROM entries')]
+    if self.fallback is not None:
+      keys = list(dict.fromkeys(keys + self.fallback.keys()))
+    return keys
+
+
+  def get(self, key: str) -> CacheEntry | None:
+    with self._lock:
+      row = self.db.execute('SELECT value, accessed, latency FROM entries WHERE key = ?', (key,)).fetchone()
+      if row is not None:
+        now = time.time()
+        if now - row[1] > self.access_resolution:
+          self.db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+
+    if row is None:
+      if self.fallback is not None and (entry := self.fallback.get(key)) is not None:
+        self.set(key, entry.value, entry.latency)
+        return entry
+      return None
+    return CacheEntry(value=json.loads(zlib.decompress(row[0])), size=len(row[0]), latency=row[2])
+
+
+  def set(self, key: str, value: Dict, latency: float | None = None):
+    data = zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+    now = time.time()
+    with self.transaction() as db:
+      existing = db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+      db.execute(
+        'INSERT OR REPLACE INTO entries (key, value, size, created, accessed, latency) VALUES (?, ?, ?, ?, ?, ?)',
+        (key, data, len(data), now, now, latency),
+      )
+      db.execute("UPDATE meta SET value = value + ? WHERE key = 'size'", (len(data) - (existing[0] if existing else 0),))
+      if self.max_size is not None:
+        self._evict(db)
+
+
+  def _evict(self, db: sqlite3.Connection):
+    size = db.execute("SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+    if size <= self.max_size:
+      return
+
+    target = size - self.max_size * self.evict_to
+    freed = 0
+    keys = []
+    for key, entry_size in db.execute('SELECT key, size FROM entries ORDER BY accessed'):
+      if freed >= target:
+        break
+      keys.append(key)
+      freed += entry_size
+    db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in keys])
+    db.execute("UPDATE meta SET value = value - ? WHERE key = 'size'", (freed,))
+    logger.info(f'Evicted {len(keys)} entries ({freed} bytes) from {self.path}')
+
+
+class LayeredCache(Cache):
+  # reads from read-only layers, such as bundles, before the cache, and
+  # writes to the cache only
+  def __init__(self, layers: List[Cache], cache: Cache | None = None):
+    self.layers = layers
+    self.cache = cache
+
+
+  def get(self, key: str) -> CacheEntry | None:
+    for layer in self.layers:
+      if (entry := layer.get(key)) is not None:
+        return entry
+    return self.cache.get(key) if self.cache is not None else None
+
+
+  def set(self, key: str, value: Dict, latency: float | None = None):
+    if self.cache is not None:
+      self.cache.set(key, value, latency)
+
+
+  def keys(self) -> List[str]:
+    keys = dict.fromkeys(self.cache.keys() if self.cache is not None else [])
+    for layer in self.layers:
+      keys.update(dict.fromkeys(layer.keys()))
+    return list(keys)
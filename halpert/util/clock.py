@@ -0,0 +1,25 @@
+import arrow
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# the date "now" is pinned to while running a sample. since this is a context
+# variable, samples running concurrently in threads or asyncio tasks each see
+# their own date
+date: ContextVar[str | None] = ContextVar('date', default=None)
+
+
+def utcnow() -> arrow.Arrow:
+  pinned = date.get()
+  if pinned is None:
+    return arrow.utcnow()
+  return arrow.get(pinned)
+
+
+@contextmanager
+def frozen(at: str):
+  token = date.set(at)
+  try:
+    yield
+  finally:
+    date.reset(token)
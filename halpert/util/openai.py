@@ -1,31 +1,192 @@
 import os
 import json
+import time
+import random
+import asyncio
 import logging
 import hashlib
+import aiohttp
 import openai
+from collections import OrderedDict
 # from openai import OpenAI
 # from openai.types.chat import ChatCompletionMessageParam, ChatCompletionToolParam, ChatCompletion, ChatCompletionNamedToolChoiceParam
-from typing import List, Dict
+from abc import ABC, abstractmethod
+from pydantic import BaseModel
+from typing import Any, Callable, List, Dict, Set, Tuple, Literal
+from .cache import Cache, CacheEntry, FileCache, SQLiteCache, LayeredCache
+from .bundle import Bundle
 
 ChatCompletionMessageParam = Dict
 ChatCompletionToolParam = Dict
 ChatCompletionNamedToolChoiceParam = str
+ToolCallCallback = Callable[[Any], None]
 
 
 logger = logging.getLogger(__name__)
 
 
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'halpert')
+# one json file per completion, as written by earlier versions
+legacy_cache_dir = os.path.join(cache_dir, 'openai-0.27.8')
+
+
+class Backend(ABC):
+  # creates chat completions, taking the same arguments as openai.ChatCompletion.create
+  # completions of backends other than the api are cached apart from its
+  # completions, under this name
+  cache_namespace: str | None = None
+
+  @abstractmethod
+  async def acreate(self, **kwargs) -> Any:
+    ...
+
+  @abstractmethod
+  def create(self, **kwargs) -> Any:
+    ...
+
+
+class OpenAIBackend(Backend):
+  async def acreate(self, **kwargs):
+    openai.aiosession.set(get_session())
+    # return await AsyncOpenAI().chat.completions.create(**kwargs)
+    return await openai.ChatCompletion.acreate(**kwargs)
+
+  def create(self, **kwargs):
+    # return OpenAI().chat.completions.create(**kwargs)
+    return openai.ChatCompletion.create(**kwargs)
+
+
+class Config(BaseModel):
+  class Config:
+    arbitrary_types_allowed = True
+
+  backend: Backend = OpenAIBackend()
+  cache: Literal['sqlite', 'file', 'none'] = 'sqlite'
+  cache_path: str | None = None
+  cache_max_size: int | None = 10 * 1024 ** 3
+  # replay bundles that are read before the cache
+  bundles: List[str] = []
+  # number of completions kept in memory in front of the cache
+  memory_cache_size: int = 1024
+  max_connections: int = 32
+  requests_per_minute: float | None = None
+  tokens_per_minute: float | None = None
+  max_retries: int = 6
+  retry_backoff: float = 1.0
+  retry_max_backoff: float = 60.0
+
+
+config = Config()
+
+
+class CacheStats(BaseModel):
+  memory_hits: int = 0
+  cache_hits: int = 0
+  misses: int = 0
+  # misses that waited for an identical request that was already in flight
+  deduplicated: int = 0
+  bytes_read: int = 0
+  # time the completions served from memory or the cache originally took
+  time_saved: float = 0
+
+  @property
+  def hit_rate(self) -> float:
+    requests = self.memory_hits + self.cache_hits + self.misses
+    return (self.memory_hits + self.cache_hits) / requests if requests else 0
+
+  def __str__(self) -> str:
+    return (
+      f'{self.memory_hits} memory hits, {self.cache_hits} cache hits, {self.misses} misses '
+      f'({self.hit_rate:.1%} hit rate, {self.deduplicated} deduplicated), {self.bytes_read / 1024 ** 2:.1f} MiB read, {self.time_saved:.1f}s saved'
+    )
+
+
+stats = CacheStats()
+
+
+class TokenBucket:
+  def __init__(self, per_minute: float):
+    self.capacity = per_minute
+    self.rate = per_minute / 60
+    self.tokens = per_minute
+    self.updated = time.monotonic()
+
+
+  def _refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+
+  async def acquire(self, amount: float = 1):
+    amount = min(amount, self.capacity)
+    while True:
+      self._refill()
+      if self.tokens >= amount:
+        self.tokens -= amount
+        return
+      await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+  def consume(self, amount: float):
+    # corrects an earlier estimate, so the bucket can go negative
+    self._refill()
+    self.tokens -= amount
+
+
+_session: aiohttp.ClientSession | None = None
+_session_loop: asyncio.AbstractEventLoop | None = None
+_buckets: Dict[str, TokenBucket] = {}
+_cache: Cache | None = None
+_cache_config: tuple | None = None
+# completions are shared between callers that hit the memory cache, so they must not be mutated
+_memory: OrderedDict[str, tuple] = OrderedDict()
+# requests that are waiting for a response, by hash
+_inflight: Dict[str, asyncio.Task] = {}
+# keys of all completions and function outputs used by this process, to export them to a bundle
+used_keys: Set[str] = set()
+
+
+def get_session() -> aiohttp.ClientSession:
+  global _session, _session_loop
+  loop = asyncio.get_running_loop()
+  if _session is None or _session.closed or _session_loop is not loop:
+    _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=config.max_connections))
+    _session_loop = loop
+  return _session
+
+
+async def close():
+  global _session
+  if _session is not None and not _session.closed:
+    await _session.close()
+  _session = None
+
+
+def get_bucket(name: str, per_minute: float | None) -> TokenBucket | None:
+  if per_minute is None:
+    return None
+  if name not in _buckets or _buckets[name].capacity != per_minute:
+    _buckets[name] = TokenBucket(per_minute)
+  return _buckets[name]
+
+
+def hash_value(arg):
+  if isinstance(arg, dict):
+    return json.dumps(arg, sort_keys=True)
+  elif hasattr(arg, 'json'):
+    return arg.json()
+  else:
+    return arg
+
+
 def create_hash(*args) -> str:
   data: List[str] = []
   for arg in args:
     if isinstance(arg, list):
       data.extend([create_hash(i) for i in arg])
-    elif isinstance(arg, dict):
-      data.append(json.dumps(arg, sort_keys=True))
-    elif hasattr(arg, 'json'):
-      data.append(arg.json())
     else:
-      data.append(arg)
+      data.append(hash_value(arg))
   return (
     hashlib
       .md5(json.dumps(data, sort_keys=True).encode('utf-8'))
@@ -33,22 +194,211 @@ def create_hash(*args) -> str:
   )
 
 
-def complete(
+class ConversationHasher:
+  # create_hash hashes every list item on its own, so a growing conversation
+  # only needs to hash the messages that are new since the last step. items
+  # are remembered by identity, so a message has to be replaced rather than
+  # mutated in place for its hash to change
+  def __init__(self):
+    self._digests: Dict[int, Tuple[object, str]] = {}
+
+
+  def hash(self, *args) -> str:
+    digests: Dict[int, Tuple[object, str]] = {}
+    data: List[str] = []
+    for arg in args:
+      if isinstance(arg, list):
+        for item in arg:
+          cached = self._digests.get(id(item))
+          if cached is None or cached[0] is not item:
+            cached = (item, create_hash(item))
+          digests[id(item)] = cached
+          data.append(cached[1])
+      else:
+        data.append(hash_value(arg))
+    self._digests = digests
+    return (
+      hashlib
+        .md5(json.dumps(data, sort_keys=True).encode('utf-8'))
+        .hexdigest()
+    )
+
+
+def request_hash(
+  messages: List[ChatCompletionMessageParam],
+  model: str,
+  tools: List[ChatCompletionToolParam],
+  tool_choice: ChatCompletionNamedToolChoiceParam | None,
+  hasher: ConversationHasher | None = None,
+) -> str:
+  args = [messages, model, tools, tool_choice]
+  if config.backend.cache_namespace is not None:
+    args.append(config.backend.cache_namespace)
+  return (hasher.hash if hasher else create_hash)(*args)
+
+
+def get_cache() -> Cache | None:
+  global _cache, _cache_config
+  cache_config = (config.cache, config.cache_path, config.cache_max_size, tuple(config.bundles))
+  if cache_config != _cache_config:
+    if config.cache == 'sqlite':
+      _cache = SQLiteCache(
+        config.cache_path or os.path.join(cache_dir, 'openai.sqlite'),
+        max_size=config.cache_max_size,
+        fallback=FileCache(legacy_cache_dir) if os.path.exists(legacy_cache_dir) else None,
+      )
+    elif config.cache == 'file':
+      _cache = FileCache(config.cache_path or legacy_cache_dir)
+    else:
+      _cache = None
+    if config.bundles:
+      _cache = LayeredCache([Bundle(path) for path in config.bundles], _cache)
+    _cache_config = cache_config
+  return _cache
+
+
+def load_value(key: str) -> CacheEntry | None:
+  cache = get_cache()
+  entry = cache.get(key) if cache is not None else None
+  if entry is not None:
+    used_keys.add(key)
+  return entry
+
+
+def save_value(key: str, value: Dict, latency: float | None = None):
+  cache = get_cache()
+  if cache is not None:
+    cache.set(key, value, latency)
+  used_keys.add(key)
+
+
+def load_cached(hash: str):
+  used_keys.add(hash)
+  if hash in _memory:
+    _memory.move_to_end(hash)
+    completion, latency = _memory[hash]
+    stats.memory_hits += 1
+    stats.time_saved += latency or 0
+    return completion
+
+  cache = get_cache()
+  entry = cache.get(hash) if cache is not None else None
+  if entry is None:
+    stats.misses += 1
+    return None
+
+  stats.cache_hits += 1
+  stats.bytes_read += entry.size
+  stats.time_saved += entry.latency or 0
+  # completion = ChatCompletion(**entry.value)
+  completion = openai.openai_object.OpenAIObject.construct_from(entry.value)
+  remember(hash, completion, entry.latency)
+  return completion
+
+
+def save_cached(hash: str, completion, latency: float | None = None):
+  cache = get_cache()
+  if cache is not None:
+    # cache.set(hash, completion.dict(), latency)
+    cache.set(hash, completion, latency)
+  remember(hash, completion, latency)
+
+
+def remember(hash: str, completion, latency: float | None):
+  if config.memory_cache_size <= 0:
+    return
+  _memory[hash] = (completion, latency)
+  _memory.move_to_end(hash)
+  while len(_memory) > config.memory_cache_size:
+    _memory.popitem(last=False)
+
+
+def get_retry_delay(error: openai.error.OpenAIError, attempt: int) -> float | None:
+  if attempt >= config.max_retries:
+    return None
+  retryable = isinstance(error, (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+  )) or (isinstance(error, openai.error.APIError) and (error.http_status or 500) >= 500)
+  if not retryable:
+    return None
+
+  retry_after = (error.headers or {}).get('retry-after')
+  if retry_after:
+    try:
+      return float(retry_after)
+    except ValueError:
+      pass
+  # exponential backoff with full jitter
+  return random.uniform(0, min(config.retry_max_backoff, config.retry_backoff * 2 ** attempt))
+
+
+def estimate_tokens(messages: List[ChatCompletionMessageParam], tools: List[ChatCompletionToolParam]) -> int:
+  return (len(json.dumps(messages)) + len(json.dumps(tools))) // 4
+
+
+async def complete(
   messages: List[ChatCompletionMessageParam],
   model: str,
   tools: List[ChatCompletionToolParam] = [],
   tool_choice: ChatCompletionNamedToolChoiceParam | None = None,
+  hasher: ConversationHasher | None = None,
+  on_tool_call: ToolCallCallback | None = None,
+):
+  # with on_tool_call, the completion is streamed and each tool call is passed
+  # to on_tool_call as soon as its arguments are complete. completions from
+  # the cache or from another caller's request pass all their tool calls at once
+  hash = request_hash(messages, model, tools, tool_choice, hasher)
+  if (completion := load_cached(hash)) is not None:
+    notify_tool_calls(completion, on_tool_call)
+    return completion
+
+  # identical requests made while one is already in flight share its response
+  task = _inflight.get(hash)
+  if task is not None and task.get_loop() is asyncio.get_running_loop():
+    stats.deduplicated += 1
+    completion = await asyncio.shield(task)
+    notify_tool_calls(completion, on_tool_call)
+    return completion
+
+  task = asyncio.ensure_future(request(hash, messages, model, tools, tool_choice, on_tool_call))
+  _inflight[hash] = task
+  task.add_done_callback(lambda t: forget_inflight(hash, t))
+  # shielded, so that a cancelled caller doesn't cancel the request for the others
+  return await asyncio.shield(task)
+
+
+def notify_tool_calls(completion, on_tool_call: ToolCallCallback | None):
+  # like assemble_stream, tool calls of completions that stopped for another reason aren't passed on
+  if on_tool_call is not None and completion.choices[0].finish_reason == 'tool_calls':
+    for tool_call in completion.choices[0].message.get('tool_calls') or []:
+      on_tool_call(tool_call)
+
+
+def forget_inflight(hash: str, task: asyncio.Task):
+  if _inflight.get(hash) is task:
+    del _inflight[hash]
+  if not task.cancelled():
+    # the exception is raised to the callers, but the task itself shouldn't be reported as unhandled
+    task.exception()
+
+
+async def request(
+  hash: str,
+  messages: List[ChatCompletionMessageParam],
+  model: str,
+  tools: List[ChatCompletionToolParam],
+  tool_choice: ChatCompletionNamedToolChoiceParam | None,
+  on_tool_call: ToolCallCallback | None = None,
 ):
-  hash = create_hash(messages, model, tools, tool_choice)
-  cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'halpert', 'openai-0.27.8', f'{hash}.json')
-  if os.path.exists(cache_path):
-    logger.info(f'Loading from cache: {cache_path}')
-    with open(cache_path, 'r') as f:
-      # return ChatCompletion(**json.load(f))
-      return openai.openai_object.OpenAIObject.construct_from(json.load(f))
-
-  # completion = OpenAI().chat.completions.create(
-  completion = openai.ChatCompletion.create(
+  requests = get_bucket('requests', config.requests_per_minute)
+  tokens = get_bucket('tokens', config.tokens_per_minute)
+  estimated_tokens = estimate_tokens(messages, tools)
+
+  kwargs = dict(
     messages=messages,
     tools=tools,
     model=model,
@@ -56,9 +406,136 @@ def complete(
     seed=42,
     tool_choice=tool_choice or 'auto',
   )
-  if not os.path.exists(os.path.dirname(cache_path)):
-    os.makedirs(os.path.dirname(cache_path))
-  with open(cache_path, 'w') as f:
-    # json.dump(completion.dict(), f, indent=2)
-    json.dump(completion, f, indent=2)
+  dispatched = []
+  def dispatch(tool_call):
+    dispatched.append(tool_call)
+    on_tool_call(tool_call)
+
+  started = time.perf_counter()
+  attempt = 0
+  while True:
+    if requests:
+      await requests.acquire()
+    if tokens:
+      await tokens.acquire(estimated_tokens)
+
+    try:
+      if on_tool_call is None:
+        completion = await config.backend.acreate(**kwargs)
+      else:
+        response = await config.backend.acreate(**kwargs, stream=True, stream_options={ 'include_usage': True })
+        completion = await assemble_stream(response, messages, tools, dispatch)
+      break
+    except openai.error.OpenAIError as e:
+      # tool calls that were already dispatched can't be taken back
+      delay = get_retry_delay(e, attempt) if not dispatched else None
+      if delay is None:
+        raise
+      attempt += 1
+      logger.warning(f'Retrying completion in {delay:.1f}s (attempt {attempt}/{config.max_retries}): {e}')
+      await asyncio.sleep(delay)
+
+  latency = time.perf_counter() - started
+
+  if tokens and 'usage' in completion:
+    tokens.consume(completion.usage.total_tokens - estimated_tokens)
+
+  save_cached(hash, completion, latency)
+  return completion
+
+
+async def assemble_stream(
+  response,
+  messages: List[ChatCompletionMessageParam],
+  tools: List[ChatCompletionToolParam],
+  on_tool_call: ToolCallCallback,
+):
+  # builds the same completion as a request without streaming would return,
+  # and passes each tool call on once the next one starts. the last one is
+  # only passed on if the stream ended on it, as its arguments are cut off
+  # when the completion stopped for another reason, e.g. its length
+  completion: Dict[str, Any] = { 'object': 'chat.completion' }
+  message: Dict[str, Any] = { 'role': 'assistant', 'content': None }
+  tool_calls: List[Dict] = []
+  finish_reason = None
+  usage = None
+
+  def dispatch(tool_call: Dict):
+    on_tool_call(openai.openai_object.OpenAIObject.construct_from(tool_call))
+
+  async for chunk in response:
+    for field in ('id', 'created', 'model', 'system_fingerprint'):
+      if chunk.get(field) is not None:
+        completion[field] = chunk[field]
+    if chunk.get('usage'):
+      usage = chunk['usage']
+    for choice in chunk.get('choices') or []:
+      delta = choice.get('delta') or {}
+      if delta.get('content'):
+        message['content'] = (message['content'] or '') + delta['content']
+      for delta_call in delta.get('tool_calls') or []:
+        if delta_call['index'] == len(tool_calls):
+          if tool_calls:
+            dispatch(tool_calls[-1])
+          tool_calls.append({ 'id': None, 'type': 'function', 'function': { 'name': '', 'arguments': '' } })
+        tool_call = tool_calls[delta_call['index']]
+        if delta_call.get('id'):
+          tool_call['id'] = delta_call['id']
+        function = delta_call.get('function') or {}
+        tool_call['function']['name'] += function.get('name') or ''
+        tool_call['function']['arguments'] += function.get('arguments') or ''
+      if choice.get('finish_reason'):
+        finish_reason = choice['finish_reason']
+  if tool_calls:
+    if finish_reason == 'tool_calls':
+      dispatch(tool_calls[-1])
+    message['tool_calls'] = tool_calls
+
+  if usage is None:
+    # the api didn't report usage for the stream, so it is estimated and marked as such
+    prompt_tokens = estimate_tokens(messages, tools)
+    completion_tokens = len(json.dumps(message)) // 4
+    usage = {
+      'prompt_tokens': prompt_tokens,
+      'completion_tokens': completion_tokens,
+      'total_tokens': prompt_tokens + completion_tokens,
+      'estimated': True,
+    }
+  completion['choices'] = [{ 'index': 0, 'message': message, 'finish_reason': finish_reason }]
+  completion['usage'] = usage
+  return openai.openai_object.OpenAIObject.construct_from(json.loads(json.dumps(completion)))
+
+
+def complete_sync(
+  messages: List[ChatCompletionMessageParam],
+  model: str,
+  tools: List[ChatCompletionToolParam] = [],
+  tool_choice: ChatCompletionNamedToolChoiceParam | None = None,
+):
+  hash = request_hash(messages, model, tools, tool_choice)
+  if (completion := load_cached(hash)) is not None:
+    return completion
+
+  started = time.perf_counter()
+  attempt = 0
+  while True:
+    try:
+      completion = config.backend.create(
+        messages=messages,
+        tools=tools,
+        model=model,
+        temperature=0,
+        seed=42,
+        tool_choice=tool_choice or 'auto',
+      )
+      break
+    except openai.error.OpenAIError as e:
+      delay = get_retry_delay(e, attempt)
+      if delay is None:
+        raise
+      attempt += 1
+      logger.warning(f'Retrying completion in {delay:.1f}s (attempt {attempt}/{config.max_retries}): {e}')
+      time.sleep(delay)
+
+  save_cached(hash, completion, time.perf_counter() - started)
   return completion
@@ -0,0 +1,196 @@
+import json
+import time
+import random
+import asyncio
+import openai
+from pydantic import BaseModel
+from typing import Any, Dict, List
+from .openai import Backend, create_hash
+
+
+class ScriptedCall(BaseModel):
+  name: str
+  # arguments are generated from the tool's schema when not set
+  arguments: Dict | None = None
+
+
+class ScriptedBackend(Backend):
+  # a local stand-in for the chat completions api, to load test the harness
+  # without network access. for each step of a conversation it either replays
+  # the calls in the script, or calls random tools with arguments generated
+  # from their schemas, and calls done once the steps are used up. responses
+  # are seeded by the conversation, so the same request gives the same response
+  cache_namespace = 'scripted'
+
+  def __init__(
+    self,
+    script: List[List[ScriptedCall]] | None = None,
+    steps: int = 3,
+    parallel_calls: int = 1,
+    latency: float = 0,
+    latency_jitter: float = 0,
+    seed: int = 0,
+  ):
+    self.script = script
+    self.steps = steps
+    self.parallel_calls = parallel_calls
+    self.latency = latency
+    self.latency_jitter = latency_jitter
+    self.seed = seed
+
+
+  async def acreate(self, stream: bool = False, **kwargs):
+    completion, latency = self._complete(**kwargs)
+    if stream:
+      return self._astream(completion, latency)
+    if latency > 0:
+      await asyncio.sleep(latency)
+    return completion
+
+
+  def create(self, stream: bool = False, **kwargs):
+    completion, latency = self._complete(**kwargs)
+    if stream:
+      return self._stream(completion, latency)
+    if latency > 0:
+      time.sleep(latency)
+    return completion
+
+
+  async def _astream(self, completion, latency: float):
+    chunks = self._chunks(completion)
+    for chunk in chunks:
+      if latency > 0:
+        await asyncio.sleep(latency / len(chunks))
+      yield chunk
+
+
+  def _stream(self, completion, latency: float):
+    chunks = self._chunks(completion)
+    for chunk in chunks:
+      if latency > 0:
+        time.sleep(latency / len(chunks))
+      yield chunk
+
+
+  def _chunks(self, completion) -> List[Any]:
+    # the latency of a streamed response is spread over its chunks, and tool
+    # call arguments arrive a few characters at a time
+    base = { 'id': completion.id, 'object': 'chat.completion.chunk', 'created': completion.created, 'model': completion.model }
+    choice = completion.choices[0]
+    deltas: List[Dict] = [{ 'role': 'assistant', 'content': None }]
+    if choice.message.get('content'):
+      deltas.append({ 'content': choice.message.content })
+    for index, tool_call in enumerate(choice.message.get('tool_calls') or []):
+      arguments = tool_call.function.arguments
+      deltas.append({ 'tool_calls': [{
+        'index': index,
+        'id': tool_call.id,
+        'type': 'function',
+        'function': { 'name': tool_call.function.name, 'arguments': '' },
+      }] })
+      deltas.extend({ 'tool_calls': [{
+        'index': index,
+        'function': { 'arguments': arguments[start:start + 16] },
+      }] } for start in range(0, len(arguments), 16))
+
+    chunks = [{ **base, 'choices': [{ 'index': 0, 'delta': delta, 'finish_reason': None }] } for delta in deltas]
+    chunks.append({ **base, 'choices': [{ 'index': 0, 'delta': {}, 'finish_reason': choice.finish_reason }] })
+    chunks.append({ **base, 'choices': [], 'usage': completion.usage })
+    return [openai.openai_object.OpenAIObject.construct_from(chunk) for chunk in chunks]
+
+
+  def _complete(
+    self,
+    messages: List[Dict],
+    model: str,
+    tools: List[Dict] = [],
+    tool_choice: Dict | str = 'auto',
+    **kwargs,
+  ):
+    rng = random.Random(f'{self.seed}:{model}:{len(messages)}:{create_hash(messages[-1]) if messages else ""}')
+    tools_by_name = { t['function']['name']: t['function'] for t in tools }
+
+    if isinstance(tool_choice, dict):
+      calls = [ScriptedCall(name=tool_choice['function']['name'])]
+    else:
+      step = sum(1 for m in messages if m.get('role') == 'assistant')
+      if self.script is not None:
+        calls = self.script[step] if step < len(self.script) else [ScriptedCall(name='done')]
+      elif step < self.steps:
+        names = [name for name in tools_by_name if name != 'done']
+        calls = [ScriptedCall(name=rng.choice(names)) for _ in range(self.parallel_calls)] if names else []
+      else:
+        calls = [ScriptedCall(name='done')]
+      calls = [c for c in calls if c.name in tools_by_name]
+
+    tool_calls = [{
+      'id': f'call_{rng.getrandbits(64):016x}',
+      'type': 'function',
+      'function': {
+        'name': call.name,
+        'arguments': json.dumps(
+          call.arguments if call.arguments is not None
+          else generate(tools_by_name[call.name].get('parameters', {}), rng)
+        ),
+      },
+    } for call in calls]
+
+    prompt_tokens = len(json.dumps(messages)) // 4
+    completion_tokens = len(json.dumps(tool_calls)) // 4
+    completion = openai.openai_object.OpenAIObject.construct_from({
+      'id': f'chatcmpl-{rng.getrandbits(64):016x}',
+      'object': 'chat.completion',
+      'created': int(time.time()),
+      'model': model,
+      'choices': [{
+        'index': 0,
+        'message': { 'role': 'assistant', 'content': None, 'tool_calls': tool_calls } if tool_calls
+          else { 'role': 'assistant', 'content': '' },
+        'finish_reason': 'tool_calls' if tool_calls else 'stop',
+      }],
+      'usage': {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+      },
+    })
+    latency = max(0, self.latency + rng.uniform(-self.latency_jitter, self.latency_jitter))
+    return completion, latency
+
+
+def generate(schema: Dict, rng: random.Random, root: Dict | None = None) -> Any:
+  root = root or schema
+  if '$ref' in schema:
+    name = schema['$ref'].split('/')[-1]
+    return generate(root.get('definitions', root.get('$defs', {}))[name], rng, root)
+  if 'enum' in schema:
+    return rng.choice(schema['enum'])
+  if 'anyOf' in schema or 'oneOf' in schema:
+    return generate(rng.choice(schema.get('anyOf', schema.get('oneOf'))), rng, root)
+  if 'allOf' in schema:
+    return generate(schema['allOf'][0], rng, root)
+
+  type = schema.get('type', 'object')
+  if type == 'object':
+    properties = schema.get('properties', {})
+    required = set(schema.get('required', []))
+    return {
+      name: generate(property, rng, root)
+      for name, property in properties.items()
+      if name in required or rng.random() < 0.5
+    }
+  elif type == 'array':
+    return [generate(schema.get('items', {}), rng, root) for _ in range(rng.randint(1, 3))]
+  elif type == 'integer':
+    return rng.randint(1, 100)
+  elif type == 'number':
+    return round(rng.uniform(0, 100), 2)
+  elif type == 'boolean':
+    return rng.random() < 0.5
+  elif type == 'null':
+    return None
+  elif 'YYYY' in schema.get('format', ''):
+    return f'2023-11-{rng.randint(1, 28):02d}'
+  else:
+    return ' '.join(rng.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet']) for _ in range(rng.randint(1, 4)))
@@ -14,4 +14,9 @@ setup(
   install_requires=[
     "pydantic",
   ],
+  entry_points={
+    "console_scripts": [
+      "halpert=halpert.__main__:main",
+    ],
+  },
 )
\ No newline at end of file